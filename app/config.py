@@ -8,6 +8,18 @@ from __future__ import annotations
 import os
 import json
 import uuid
+import atexit
+import threading
+from contextlib import contextmanager
+
+try:
+    import orjson
+
+    def _dumps(data: dict) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def _dumps(data: dict) -> bytes:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode()
 
 APP_VERSION = "0.1.0"
 PROXY_URL_DEFAULT = "https://proxy.protagonist.app/v1"
@@ -42,12 +54,35 @@ DEFAULT_TOOLS = {
 }
 
 _config: dict | None = None
+_dirty = False
+_batching = 0
+_flush_timer: threading.Timer | None = None
+# _save_lock guards _config contents and _dirty (re-entrant so set() can hold it into
+# _mark_dirty); _write_lock orders snapshot+write so an older snapshot never lands last
+_save_lock = threading.RLock()
+_write_lock = threading.Lock()
+
+# Bumped on every change so derived values (e.g. enabled tools) can be cached
+_version = 0
+_enabled_cache: list[str] | None = None
+_enabled_set: frozenset[str] | None = None
+
+# Bursts of set() calls within this window are coalesced into a single write
+SAVE_DELAY = 0.1
 
 
 def _ensure_dir():
     os.makedirs(CONFIG_DIR, exist_ok=True)
 
 
+def _invalidate():
+    """Bump the config version and drop cached derived values."""
+    global _version, _enabled_cache, _enabled_set
+    _version += 1
+    _enabled_cache = None
+    _enabled_set = None
+
+
 def load() -> dict:
     """Load config from disk, or return defaults."""
     global _config
@@ -62,27 +97,96 @@ def load() -> dict:
         _config = {}
 
     # Fill in defaults
-    _config.setdefault("device_id", str(uuid.uuid4()))
+    before = len(_config)
+    if "device_id" not in _config:
+        _config["device_id"] = str(uuid.uuid4())
     _config.setdefault("telegram_bot_token", "")
     _config.setdefault("proxy_url", PROXY_URL_DEFAULT)
     _config.setdefault("openai_api_key", "")  # Direct OpenAI key (fallback)
     _config.setdefault("openrouter_api_key", "")
     _config.setdefault("llm_model", "gpt-4o-mini")
-    _config.setdefault("tools", DEFAULT_TOOLS.copy())
+    if "tools" not in _config:
+        _config["tools"] = dict(DEFAULT_TOOLS)
     _config.setdefault("setup_complete", False)
 
-    save()
+    _invalidate()
+    # Only persist if defaults were actually added
+    if len(_config) != before:
+        save(force=True)
     return _config
 
 
-def save():
-    """Save config to disk."""
-    global _config
-    if _config is None:
-        return
-    _ensure_dir()
-    with open(CONFIG_PATH, "w") as f:
-        json.dump(_config, f, indent=2, ensure_ascii=False)
+def save(force: bool = False):
+    """Save config to disk.
+
+    Only writes when there are unsaved changes, unless force is set.
+    """
+    global _dirty, _flush_timer
+    with _write_lock:
+        with _save_lock:
+            if _flush_timer is not None:
+                _flush_timer.cancel()
+                _flush_timer = None
+            if _config is None or not (_dirty or force):
+                return
+            # Snapshot and clear the flag before any I/O: a set() landing during the
+            # write marks the config dirty again and gets its own save.
+            data = _dumps(_config)
+            _dirty = False
+        _ensure_dir()
+        # Write to a temp file and rename over the original, so a crash
+        # mid-write never leaves a torn config behind.
+        tmp = CONFIG_PATH + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, CONFIG_PATH)
+
+
+def _flush():
+    """Write any pending changes (timer / exit hook)."""
+    if _dirty:
+        save()
+
+
+def _mark_dirty():
+    """Record a change and schedule a debounced save.
+
+    Multiple changes inside SAVE_DELAY (or inside a batch()) are coalesced —
+    only the latest state is written.
+    """
+    global _dirty, _flush_timer
+    with _save_lock:
+        _dirty = True
+        if _batching:
+            return
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+        _flush_timer = threading.Timer(SAVE_DELAY, _flush)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+@contextmanager
+def batch():
+    """Group several changes into one write.
+
+        with config.batch():
+            config.set("a", 1)
+            config.set("b", 2)
+    """
+    global _batching
+    _batching += 1
+    try:
+        yield
+    finally:
+        _batching -= 1
+        if not _batching:
+            _flush()
+
+
+atexit.register(_flush)
 
 
 def get(key: str, default=None):
@@ -91,9 +195,12 @@ def get(key: str, default=None):
 
 
 def set(key: str, value):
-    """Set a config value and save."""
-    load()[key] = value
-    save()
+    """Set a config value (saved shortly after)."""
+    cfg = load()
+    with _save_lock:
+        cfg[key] = value
+        _invalidate()
+        _mark_dirty()
 
 
 def is_setup_complete() -> bool:
@@ -104,11 +211,34 @@ def is_setup_complete() -> bool:
 
 def get_enabled_tools() -> list[str]:
     """Get list of enabled tool names."""
-    tools = load().get("tools", {})
-    return [name for name, enabled in tools.items() if enabled]
+    global _enabled_cache
+    if _enabled_cache is None:
+        tools = load().get("tools", {})
+        _enabled_cache = [name for name, enabled in tools.items() if enabled]
+    return list(_enabled_cache)
+
+
+def enabled_tools_set() -> frozenset[str]:
+    """Enabled tool names as a frozenset, for O(1) membership checks."""
+    global _enabled_set
+    if _enabled_set is None:
+        _enabled_set = frozenset(get_enabled_tools())
+    return _enabled_set
 
 
 def set_tool_enabled(name: str, enabled: bool):
     """Toggle a specific tool."""
-    load().setdefault("tools", {})[name] = enabled
-    save()
+    cfg = load()
+    with _save_lock:
+        cfg.setdefault("tools", {})[name] = enabled
+        _invalidate()
+        _mark_dirty()
+
+
+def set_tools_bulk(mapping: dict[str, bool]):
+    """Set many tool states at once with a single save."""
+    cfg = load()
+    with _save_lock:
+        cfg.setdefault("tools", {}).update(mapping)
+        _invalidate()
+    save(force=True)
@@ -7,9 +7,11 @@ from __future__ import annotations
 
 import os
 import sys
+import time
 import asyncio
 import threading
 import json
+import urllib.error
 import urllib.request
 import webbrowser
 
@@ -39,30 +41,35 @@ TOOL_CATEGORIES = {
     "Documents": ["create_document"],
 }
 
+# Flattened view, built once
+ALL_TOOLS = tuple(t for tools in TOOL_CATEGORIES.values() for t in tools)
+
 
 class ProtagonistApp(rumps.App):
     def __init__(self):
         super().__init__("Protagonist", icon=None, title="\U0001f91d")
         self.bot_thread = None
         self.bot_running = False
+        self._status_item: rumps.MenuItem | None = None
+        self._count_item: rumps.MenuItem | None = None
+        self._tool_items: dict[str, rumps.MenuItem] = {}
         self._build_menu()
 
     def _build_menu(self):
         cfg = config.load()
-        enabled = config.get_enabled_tools()
+        enabled = config.enabled_tools_set()
         total = len(cfg.get("tools", {}))
 
         self.menu.clear()
+        self._count_item = None
+        self._tool_items = {}
 
         if config.is_setup_complete():
-            self.menu = [
-                rumps.MenuItem("Status: Starting bot...", callback=None),
-                None,
-                rumps.MenuItem(
-                    f"Tools: {len(enabled)}/{total} enabled", callback=None,
-                ),
-                None,
-            ]
+            self._status_item = rumps.MenuItem("Status: Starting bot...", callback=None)
+            self._count_item = rumps.MenuItem(
+                f"Tools: {len(enabled)}/{total} enabled", callback=None,
+            )
+            self.menu = [self._status_item, None, self._count_item, None]
             # Tool category toggles
             for category, tools in TOOL_CATEGORIES.items():
                 submenu = rumps.MenuItem(category)
@@ -70,6 +77,7 @@ class ProtagonistApp(rumps.App):
                     item = rumps.MenuItem(tool_name, callback=self._toggle_tool)
                     item.state = 1 if tool_name in enabled else 0
                     submenu.add(item)
+                    self._tool_items[tool_name] = item
                 self.menu.add(submenu)
 
             self.menu.add(None)
@@ -78,8 +86,9 @@ class ProtagonistApp(rumps.App):
             self.menu.add(None)
             self.menu.add(rumps.MenuItem("Reconfigure...", callback=self._reconfigure))
         else:
+            self._status_item = rumps.MenuItem("Status: Not configured", callback=None)
             self.menu = [
-                rumps.MenuItem("Status: Not configured", callback=None),
+                self._status_item,
                 None,
                 rumps.MenuItem("Set Up...", callback=self._run_setup),
                 None,
@@ -93,41 +102,29 @@ class ProtagonistApp(rumps.App):
         self._update_tool_count()
 
     def _enable_all(self, _):
-        for tools in TOOL_CATEGORIES.values():
-            for t in tools:
-                config.set_tool_enabled(t, True)
+        config.set_tools_bulk({t: True for t in ALL_TOOLS})
         self._refresh_checks()
 
     def _disable_all(self, _):
-        for tools in TOOL_CATEGORIES.values():
-            for t in tools:
-                config.set_tool_enabled(t, False)
+        config.set_tools_bulk({t: False for t in ALL_TOOLS})
         self._refresh_checks()
 
     def _refresh_checks(self):
-        enabled = config.get_enabled_tools()
-        for category in TOOL_CATEGORIES:
-            if category in self.menu:
-                for tool_name in TOOL_CATEGORIES[category]:
-                    if tool_name in self.menu[category]:
-                        self.menu[category][tool_name].state = (
-                            1 if tool_name in enabled else 0
-                        )
+        enabled = config.enabled_tools_set()
+        for tool_name, item in self._tool_items.items():
+            item.state = 1 if tool_name in enabled else 0
         self._update_tool_count()
 
     def _update_tool_count(self):
+        if self._count_item is None:
+            return
         enabled = config.get_enabled_tools()
         total = len(config.load().get("tools", {}))
-        for key in self.menu.keys():
-            if "Tools:" in str(key):
-                self.menu[key].title = f"Tools: {len(enabled)}/{total} enabled"
-                break
+        self._count_item.title = f"Tools: {len(enabled)}/{total} enabled"
 
     def _update_status(self, status: str):
-        for key in self.menu.keys():
-            if "Status:" in str(key):
-                self.menu[key].title = f"Status: {status}"
-                break
+        if self._status_item is not None:
+            self._status_item.title = f"Status: {status}"
 
     def _run_setup(self, _=None):
         if run_setup():
@@ -144,19 +141,20 @@ class ProtagonistApp(rumps.App):
         if self.bot_running:
             return
 
-        token = config.get("telegram_bot_token", "")
+        cfg = config.load()
+        token = cfg.get("telegram_bot_token", "")
         if not token:
             self._update_status("No bot token")
             return
 
         # Set env vars for the agent to use
-        proxy_url = config.get("proxy_url", "")
+        proxy_url = cfg.get("proxy_url", "")
         if proxy_url:
             os.environ["PROXY_URL"] = proxy_url
-            os.environ["DEVICE_ID"] = config.get("device_id", "")
-        os.environ["OPENAI_API_KEY"] = config.get("openai_api_key", "")
-        os.environ["OPENROUTER_API_KEY"] = config.get("openrouter_api_key", "")
-        os.environ["LLM_MODEL"] = config.get("llm_model", "gpt-4o-mini")
+            os.environ["DEVICE_ID"] = cfg.get("device_id", "")
+        os.environ["OPENAI_API_KEY"] = cfg.get("openai_api_key", "")
+        os.environ["OPENROUTER_API_KEY"] = cfg.get("openrouter_api_key", "")
+        os.environ["LLM_MODEL"] = cfg.get("llm_model", "gpt-4o-mini")
 
         def run():
             self.bot_running = True
@@ -182,17 +180,44 @@ class ProtagonistApp(rumps.App):
 
 # --------------- Auto-Update ---------------
 
+UPDATE_CHECK_INTERVAL = 6 * 3600  # seconds between GitHub release checks
+
+
 def _check_for_updates():
     """Check GitHub Releases for a newer version (runs in background)."""
     try:
         from app.config import APP_VERSION, GITHUB_REPO
 
+        cfg = config.load()
+        now = time.time()
+        if now - cfg.get("last_update_check_ts", 0) < UPDATE_CHECK_INTERVAL:
+            return
+
         url = f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest"
-        req = urllib.request.Request(
-            url, headers={"Accept": "application/vnd.github.v3+json"},
-        )
-        resp = urllib.request.urlopen(req, timeout=10)
-        data = json.loads(resp.read().decode())
+        headers = {"Accept": "application/vnd.github.v3+json"}
+        etag = cfg.get("last_update_etag", "")
+        if etag and cfg.get("last_update_tag"):  # a 304 is only useful with the release cached
+            headers["If-None-Match"] = etag
+        req = urllib.request.Request(url, headers=headers)
+        try:
+            resp = urllib.request.urlopen(req, timeout=10)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            # Not modified since the last check: compare against the cached release so a
+            # newer version the user postponed with "Later" is still offered again
+            config.set("last_update_check_ts", now)
+            data = {
+                "tag_name": cfg.get("last_update_tag", ""),
+                "html_url": cfg.get("last_update_url", ""),
+            }
+        else:
+            data = json.loads(resp.read().decode())
+            with config.batch():
+                config.set("last_update_check_ts", now)
+                config.set("last_update_etag", resp.headers.get("ETag", ""))
+                config.set("last_update_tag", data.get("tag_name", ""))
+                config.set("last_update_url", data.get("html_url", ""))
 
         latest_tag = data.get("tag_name", "")
         # Strip leading 'v' for comparison
@@ -4,6 +4,7 @@ from __future__ import annotations
 import webbrowser
 import urllib.request
 import json
+import threading
 import rumps
 
 from app import config
@@ -90,15 +91,19 @@ def run_setup() -> bool:
         )
         return False
 
-    # Step 4: Register device with proxy
+    # Step 4: Register device with proxy (fire-and-forget, don't block the UI)
     device_id = config.get("device_id", "")
     if device_id:
-        _register_device(device_id, config.get("proxy_url", ""))
+        threading.Thread(
+            target=_register_device,
+            args=(device_id, config.get("proxy_url", "")),
+            daemon=True,
+        ).start()
 
-    # Step 5: Save config
-    config.set("telegram_bot_token", token)
-    config.set("setup_complete", True)
-    config.save()
+    # Step 5: Save config (one write)
+    with config.batch():
+        config.set("telegram_bot_token", token)
+        config.set("setup_complete", True)
 
     rumps.alert(
         title="All Set!",
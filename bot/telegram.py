@@ -8,9 +8,21 @@ from __future__ import annotations
 
 import os
 import asyncio
+import bisect
+import functools
+import logging
+import logging.handlers
+import queue
+import sys
 import random
-import base64
+import io
+import hashlib
+import shutil
+import tempfile
+import time
 from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator
 
 from telegram import Update
 from telegram.ext import (
@@ -21,26 +33,14 @@ from telegram.ext import (
     ContextTypes,
 )
 
-from core.agent import (
-    respond, respond_to_photo, extract_promises,
-    follow_up_on_promise, checkin, write_milestone_letter,
-    update_user_profile, update_memory_summary,
-    update_relationship_narrative, detect_mood,
-    extract_shared_references, compose_surprise,
-    detect_patterns, share_pattern_insight,
-    generate_inner_thought, proactive_followup,
-    get_absence_hint, compose_return_message, generate_voice,
-    classify_sticker_emotion, pick_response_emotion,
-    extract_events as agent_extract_events,
-    compose_greeting,
-    update_user_story, get_user_story,
-    MILESTONE_COUNTS,
-)
 from core.state import UserState
 
 # --------------- State ---------------
 
-state = UserState()
+logger = logging.getLogger("bot.telegram")
+_log_listener: logging.handlers.QueueListener | None = None
+
+state: UserState | None = None  # Created in create_bot()
 _checkin_tasks: dict[str, asyncio.Task] = {}
 _owner_id: str | None = None  # Set via create_bot(); None = allow all
 
@@ -58,23 +58,61 @@ def _user_id(update: Update) -> str:
     return f"tg:{update.effective_user.id}"
 
 
-async def _keep_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+_TYPING_GRACE = 0.8  # fast replies finish before any chat action is sent
+_PHOTO_MIN_SIDE = 512
+
+
+async def _keep_typing(bot, chat_id: int, delay: float = 0.0):
+    """Show "typing" until cancelled, optionally only once `delay` has passed."""
     try:
+        if delay:
+            await asyncio.sleep(delay)
         while True:
-            await context.bot.send_chat_action(chat_id, "typing")
-            await asyncio.sleep(4)
+            await bot.send_chat_action(chat_id, "typing")
+            await asyncio.sleep(4.5)  # the action itself lasts ~5s server-side
     except asyncio.CancelledError:
         pass
 
 
-async def _send_parts(context: ContextTypes.DEFAULT_TYPE, chat_id: int, parts: list[str]):
-    for i, text in enumerate(parts):
-        await context.bot.send_chat_action(chat_id, "typing")
-        delay = max(0.5, min(3.0, len(text) * 0.12)) + random.uniform(-0.2, 0.4)
-        await asyncio.sleep(max(0.3, delay))
-        await context.bot.send_message(chat_id, text)
-        if i < len(parts) - 1:
-            await asyncio.sleep(random.uniform(0.2, 0.6))
+def _part_delay(text: str) -> float:
+    return max(0.3, max(0.5, min(3.0, len(text) * 0.12)) + random.random() * 0.6 - 0.2)
+
+
+async def _iter_parts(parts: list[str]) -> AsyncIterator[str]:
+    for text in parts:
+        yield text
+
+
+async def _deliver(bot, chat_id: int, parts: list[str] | AsyncIterator[str],
+                   sent: list[str] = None, typing_delay: float = 0.0):
+    """Send reply parts with human-ish pacing; shared by handlers and scheduled jobs.
+
+    `parts` may be a list or a stream of parts as the model finishes them. Either way one
+    typing loop and one pacing sequence cover the whole reply. Each delivered part is
+    appended to `sent`, so callers can persist what the user saw even if the stream fails.
+    """
+    if isinstance(parts, list):
+        parts = _iter_parts(parts)
+    # One typing loop for the whole reply instead of a chat action per part
+    typing_task = asyncio.create_task(_keep_typing(bot, chat_id, typing_delay))
+    first = True
+    try:
+        async for text in parts:
+            if not first:
+                await asyncio.sleep(0.2 + random.random() * 0.4)  # gap between parts
+            first = False
+            await asyncio.sleep(_part_delay(text))
+            await bot.send_message(chat_id, text)
+            if sent is not None:
+                sent.append(text)
+    finally:
+        typing_task.cancel()
+
+
+async def _send_parts(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
+                      parts: list[str] | AsyncIterator[str], sent: list[str] = None,
+                      typing_delay: float = 0.0):
+    return await _deliver(context.bot, chat_id, parts, sent, typing_delay)
 
 
 _IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
@@ -86,33 +124,69 @@ async def _send_files(context: ContextTypes.DEFAULT_TYPE, chat_id: int, files: l
         try:
             if os.path.exists(path):
                 ext = os.path.splitext(path)[1].lower()
-                with open(path, "rb") as f:
-                    if ext in _IMAGE_EXTS:
-                        await context.bot.send_photo(chat_id, photo=f)
-                    else:
-                        await context.bot.send_document(chat_id, document=f, filename=os.path.basename(path))
+                # PTB opens local paths itself; no file object to manage here
+                if ext in _IMAGE_EXTS:
+                    await context.bot.send_photo(chat_id, photo=Path(path))
+                else:
+                    await context.bot.send_document(chat_id, document=Path(path), filename=os.path.basename(path))
                 os.unlink(path)
-        except Exception as e:
-            print(f"[telegram] Failed to send file {path}: {e}")
+        except Exception:
+            logger.exception("[telegram] Failed to send file %s", path)
+
+
+_VOICE_CACHE_DIR = os.path.expanduser("~/.protagonist/voice_cache")
+_VOICE_CACHE_MAX = 500
+
+
+async def _cached_voice(text: str) -> str | None:
+    """Return a synthesized voice file for text, reusing a cached one if present."""
+    from core.agent import generate_voice, VOICE_ID
+    key = hashlib.blake2b(f"{VOICE_ID}|{text}".encode(), digest_size=16).hexdigest()
+    path = os.path.join(_VOICE_CACHE_DIR, f"{key}.ogg")
+    if os.path.exists(path):
+        os.utime(path)  # Mark as recently used
+        return path
+
+    generated = await generate_voice(text)
+    if not generated:
+        return None
+    os.makedirs(_VOICE_CACHE_DIR, exist_ok=True)
+    shutil.move(generated, path)
+    _evict_voice_cache()
+    return path
+
+
+def _evict_voice_cache():
+    """Drop least recently used voice files beyond _VOICE_CACHE_MAX."""
+    try:
+        entries = [e for e in os.scandir(_VOICE_CACHE_DIR) if e.name.endswith(".ogg")]
+        if len(entries) <= _VOICE_CACHE_MAX:
+            return
+        entries.sort(key=lambda e: e.stat().st_atime)
+        for e in entries[:len(entries) - _VOICE_CACHE_MAX]:
+            os.unlink(e.path)
+    except OSError:
+        logger.exception("[voice] Cache eviction error")
 
 
 async def _send_as_voice_or_text(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str):
     """Try to send as voice message, fall back to text."""
-    voice_path = await generate_voice(text)
+    voice_path = await _cached_voice(text)
     if voice_path:
         try:
-            with open(voice_path, "rb") as f:
-                await context.bot.send_voice(chat_id, voice=f)
-            os.unlink(voice_path)
+            await context.bot.send_voice(chat_id, voice=Path(voice_path))
             return True
-        except Exception as e:
-            print(f"[voice] Send error: {e}")
+        except Exception:
+            logger.exception("[voice] Send error")
     await context.bot.send_message(chat_id, text)
     return False
 
 
 # --------------- Handlers ---------------
 
+_STORY_TRIGGERS = frozenset({"我的故事", "给我看看我的故事", "看看我的故事", "my story", "show me my story"})
+
+
 async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not _is_owner(update):
         await update.message.reply_text("This is a private bot.")
@@ -125,8 +199,7 @@ async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # (ONBOARDING_HINT injects when profile is empty + count < 10)
     parts = ["嘿", "你是？"]
     await _send_parts(context, chat_id, parts)
-    for p in parts:
-        state.add_message(uid, "friend", p)
+    state.add_messages(uid, "friend", parts)
 
 
 async def handle_memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -185,34 +258,43 @@ async def handle_forget(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from core.agent import (
+        respond_stream, get_absence_hint, compose_return_message, compose_return_message_stream,
+        get_user_story,
+        MILESTONE_COUNTS, _MAX_MILESTONE,
+    )
     if not _is_owner(update):
         await update.message.reply_text("This is a private bot.")
         return
     uid = _user_id(update)
     chat_id = update.effective_chat.id
     text = update.message.text
+    now_ts = time.time()  # one snapshot for the whole turn
     state.set_chat_id(uid, chat_id)
 
     # --- Absence detection (before storing message) ---
     last_time = state.get_last_message_time(uid)
     absence_hours = 0
     if last_time:
-        absence_hours = (datetime.now().timestamp() - last_time) / 3600
+        absence_hours = (now_ts - last_time) / 3600
 
     # Long absence (7+ days): send return message first
     if absence_hours > 24 * 7:
+        return_parts: list[str] = []
         try:
-            return_parts = await compose_return_message(uid, absence_hours / 24)
             if absence_hours > 24 * 14 and random.random() < 0.5:
-                combined = " ".join(return_parts)
-                await _send_as_voice_or_text(context, chat_id, combined)
+                # A voice note needs the whole text up front
+                voice_parts = await compose_return_message(uid, absence_hours / 24)
+                await _send_as_voice_or_text(context, chat_id, " ".join(voice_parts))
+                return_parts.extend(voice_parts)
             else:
-                await _send_parts(context, chat_id, return_parts)
-            for p in return_parts:
-                state.add_message(uid, "friend", p)
+                await _send_parts(context, chat_id, compose_return_message_stream(uid, absence_hours / 24), return_parts)
+        except Exception:
+            logger.exception("[return] Error")
+        # Whatever reached the user is part of the conversation, even if the stream broke
+        state.add_messages(uid, "friend", return_parts)
+        if return_parts:
             await asyncio.sleep(random.uniform(1.5, 3.0))
-        except Exception as e:
-            print(f"[return] Error: {e}")
 
     # Build absence hint for 1-7 day absences
     absence_hint = get_absence_hint(absence_hours) if 24 <= absence_hours <= 24 * 7 else ""
@@ -220,13 +302,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state.add_message(uid, "user", text)
 
     if state.first_message_time(uid) is None:
-        state.set_meta(uid, "first_message_time", str(datetime.now().timestamp()))
+        state.set_meta(uid, "first_message_time", str(now_ts))
 
     count = state.message_count(uid)
 
     # --- "My Story" trigger ---
-    _story_triggers = {"我的故事", "给我看看我的故事", "看看我的故事", "my story", "show me my story"}
-    if text.strip().lower() in _story_triggers or text.strip() in _story_triggers:
+    stripped = text.strip()
+    if stripped in _STORY_TRIGGERS or stripped.lower() in _STORY_TRIGGERS:
         story = get_user_story(uid)
         if story:
             await context.bot.send_message(chat_id, story)
@@ -237,68 +319,72 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Not enough data yet — let LLM respond naturally
             pass
 
-    typing_task = asyncio.create_task(_keep_typing(context, chat_id))
+    parts: list[str] = []
+    files: list[str] = []
     try:
         history = state.get_history(uid)
-        parts, files = await respond(history[:-1], text, user_id=uid, absence_hint=absence_hint)
+        # Send each part as soon as the model finishes it, not after the whole reply
+        await _send_parts(
+            context, chat_id,
+            respond_stream(history[:-1], text, user_id=uid, absence_hint=absence_hint, created_files=files),
+            parts, typing_delay=_TYPING_GRACE,
+        )
     finally:
-        typing_task.cancel()
-
-    await _send_parts(context, chat_id, parts)
-    for p in parts:
-        state.add_message(uid, "friend", p)
+        # Persist whatever the user actually received, even if the stream broke midway
+        state.add_messages(uid, "friend", parts)
 
     if files:
         await _send_files(context, chat_id, files)
 
-    # Memory updates (background, non-blocking)
+    # Memory updates (background, non-blocking, serialized per user)
     if count % 10 == 0 and count > 0:
-        asyncio.create_task(_extract_promises(uid))
+        _enqueue_bg(uid, "promises")
     if count % 20 == 0 and count > 0:
-        asyncio.create_task(_update_memory(uid))
+        _enqueue_bg(uid, "memory")
 
-    if count in MILESTONE_COUNTS and count not in state.milestones_sent(uid):
+    if count <= _MAX_MILESTONE and count in MILESTONE_COUNTS and count not in state.milestones_sent(uid):
         state.mark_milestone(uid, count)
         asyncio.create_task(_send_milestone(uid, chat_id, context))
 
     # Extract events every 5 messages
     if count % 5 == 0 and count > 0:
-        asyncio.create_task(_extract_events(uid))
-
-    # Extract shared references every 15 messages
-    if count % 15 == 0 and count > 0:
-        asyncio.create_task(_extract_shared_refs(uid))
+        _enqueue_bg(uid, "events")
 
-    # Maybe send a sticker reaction (15% chance)
-    asyncio.create_task(_maybe_send_sticker(uid, chat_id, context, parts))
+    # Maybe send a sticker reaction (15% chance) — roll here so most turns spawn no task
+    if random.random() < 0.15:
+        asyncio.create_task(_maybe_send_sticker(uid, chat_id, context, parts))
 
     _schedule_checkin(uid, chat_id, context)
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from core.agent import respond_to_photo
     if not _is_owner(update):
         return
     uid = _user_id(update)
     chat_id = update.effective_chat.id
     state.set_chat_id(uid, chat_id)
 
-    photo = update.message.photo[-1]
+    # The model sees photos at detail="low" (512px), so fetch the smallest
+    # size Telegram already rendered that still covers that, not the original.
+    sizes = update.message.photo
+    photo = next((p for p in sizes if max(p.width, p.height) >= _PHOTO_MIN_SIDE), sizes[-1])
     file = await context.bot.get_file(photo.file_id)
-    data = await file.download_as_bytearray()
-    b64 = base64.b64encode(bytes(data)).decode()
+    # Download into one buffer and hand the agent a view of it (no extra copies)
+    buf = io.BytesIO()
+    await file.download_to_memory(buf)
 
     state.add_message(uid, "user", "[photo]", "photo")
 
-    typing_task = asyncio.create_task(_keep_typing(context, chat_id))
+    typing_task = asyncio.create_task(_keep_typing(context.bot, chat_id, _TYPING_GRACE))
     try:
         history = state.get_history(uid)
-        parts = await respond_to_photo(history, b64)
+        parts = await respond_to_photo(history, buf.getbuffer())
     finally:
         typing_task.cancel()
 
     await _send_parts(context, chat_id, parts)
-    for p in parts:
-        state.add_message(uid, "friend", p)
+    state.add_messages(uid, "friend", parts)
     _schedule_checkin(uid, chat_id, context)
 
 
@@ -310,24 +396,23 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state.set_chat_id(uid, chat_id)
 
     file = await context.bot.get_file(update.message.voice.file_id)
-    data = await file.download_as_bytearray()
 
-    import tempfile
-    from core.agent import get_client
+    from core.agent import get_client, respond
 
     try:
-        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as f:
-            f.write(bytes(data))
-            f.flush()
-            transcript = await get_client().audio.transcriptions.create(
-                model="whisper-1",
-                file=open(f.name, "rb"),
-                language="zh",
-            )
-            os.unlink(f.name)
-            text = transcript.text
-    except Exception as e:
-        print(f"[voice] Transcription error: {e}")
+        # Keep the audio in memory; the name tells Whisper the format
+        buf = io.BytesIO()
+        buf.name = "voice.ogg"
+        await file.download_to_memory(buf)
+        buf.seek(0)
+        transcript = await get_client().audio.transcriptions.create(
+            model="whisper-1",
+            file=buf,
+            language="zh",
+        )
+        text = transcript.text
+    except Exception:
+        logger.exception("[voice] Transcription error")
         text = ""
 
     if not text:
@@ -336,7 +421,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     state.add_message(uid, "user", text, "voice")
 
-    typing_task = asyncio.create_task(_keep_typing(context, chat_id))
+    typing_task = asyncio.create_task(_keep_typing(context.bot, chat_id, _TYPING_GRACE))
     try:
         history = state.get_history(uid)
         parts, files = await respond(history[:-1], text, user_id=uid)
@@ -344,8 +429,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         typing_task.cancel()
 
     await _send_parts(context, chat_id, parts)
-    for p in parts:
-        state.add_message(uid, "friend", p)
+    state.add_messages(uid, "friend", parts)
 
     if files:
         await _send_files(context, chat_id, files)
@@ -355,160 +439,211 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --------------- Background Tasks ---------------
 
+def _store_promises(uid: str, promises: list[dict]):
+    """Save newly extracted promises, skipping ones already on file."""
+    known = {p["thing"] for p in state.get_promises(uid)}
+    for p in promises:
+        thing = p.get("thing", "")
+        if thing and thing not in known:
+            known.add(thing)
+            state.add_promise(uid, thing, p.get("original", ""))
+
+
 async def _extract_promises(uid: str):
+    from core.agent import extract_promises
     try:
+        # Promises only come from the user's own messages — skip if none arrived since the last scan
+        latest = state.latest_message_id(uid, "user")
+        if latest == state.get_watermark(uid, "promises"):
+            return
         history = state.get_history(uid)
-        new_promises = await extract_promises(history)
-        for p in new_promises:
-            state.add_promise(uid, p.get("thing", ""), p.get("original", ""))
-    except Exception as e:
-        print(f"[promise] Error for {uid}: {e}")
+        _store_promises(uid, await extract_promises(history))
+        state.set_watermark(uid, "promises", latest)
+    except Exception:
+        logger.exception("[promise] Error for %s", uid)
 
 
 async def _update_memory(uid: str):
-    """Update user profile, conversation summary, narrative, mood, patterns, and story (background)."""
+    """Update profile, summary, narrative, mood, story, shared references and patterns (background)."""
+    from core.agent import run_memory_cycle
     try:
-        await update_user_profile(uid)
-        await update_memory_summary(uid)
-        await update_relationship_narrative(uid)
-        await detect_mood(uid)
-        await detect_patterns(uid)
-        await update_user_story(uid)
-    except Exception as e:
-        print(f"[memory] Error for {uid}: {e}")
-
-
-async def _extract_shared_refs(uid: str):
-    """Extract inside jokes and memorable moments (background)."""
-    try:
-        await extract_shared_references(uid)
-    except Exception as e:
-        print(f"[refs] Error for {uid}: {e}")
+        await run_memory_cycle(uid)
+    except Exception:
+        logger.exception("[memory] Error for %s", uid)
 
 
 async def _send_milestone(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    from core.agent import write_milestone_letter
+    letter_task = None
     try:
+        # Write the letter while the announcement plays out instead of after it
+        history = state.get_history(uid)
+        now_ts = time.time()
+        first_time = state.first_message_time(uid) or now_ts
+        days = max(1, int((now_ts - first_time) / 86400))
+        letter_task = asyncio.create_task(write_milestone_letter(history, days))
+
         await asyncio.sleep(5)
         announce = ["诶 等一下", "我想跟你说点东西"]
         await _send_parts(context, chat_id, announce)
-        for p in announce:
-            state.add_message(uid, "friend", p)
+        state.add_messages(uid, "friend", announce)
 
         await asyncio.sleep(2)
-        history = state.get_history(uid)
-        first_time = state.first_message_time(uid) or datetime.now().timestamp()
-        days = max(1, int((datetime.now().timestamp() - first_time) / 86400))
-        letter = await write_milestone_letter(history, days)
+        letter = await letter_task
 
         await context.bot.send_chat_action(chat_id, "typing")
         await asyncio.sleep(2)
         await _send_as_voice_or_text(context, chat_id, letter)
         state.add_message(uid, "friend", letter)
-        print(f"[milestone] Sent letter to {uid} at {state.message_count(uid)} messages")
-    except Exception as e:
-        print(f"[milestone] Error: {e}")
+        logger.info("[milestone] Sent letter to %s at %s messages", uid, state.message_count(uid))
+    except Exception:
+        logger.exception("[milestone] Error")
+        if letter_task is not None:
+            letter_task.cancel()
 
 
 def _schedule_checkin(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    if uid in _checkin_tasks and not _checkin_tasks[uid].done():
-        _checkin_tasks[uid].cancel()
-    _checkin_tasks[uid] = asyncio.create_task(_do_checkin(uid, chat_id, context))
+    existing = _checkin_tasks.get(uid)
+    if existing and not existing.done():
+        existing.cancel()
+    task = asyncio.create_task(_do_checkin(uid, chat_id, context))
+    _checkin_tasks[uid] = task
+    task.add_done_callback(lambda t: _forget_task(_checkin_tasks, uid, t))
+
+
+def _forget_task(tasks: dict[str, asyncio.Task], uid: str, task: asyncio.Task):
+    """Drop a finished per-user task so the registry only holds active users."""
+    if tasks.get(uid) is task:
+        del tasks[uid]
+
+
+# Proactive check-in bands: (cumulative roll bound, kind, min user messages).
+# A roll lands in the first band above it; if the user is too new for that
+# kind, the next eligible band further up is used instead.
+_CHECKIN_BANDS = (
+    (0.05, "surprise", 20),   # 5%: surprise gift
+    (0.13, "pattern", 50),    # 8%: pattern insight
+    (0.21, "thought", 30),    # 8%: inner thought
+    (0.31, "followup", 10),   # 10%: proactive follow-up research
+)
+_CHECKIN_BOUNDS = [bound for bound, _, _ in _CHECKIN_BANDS]
+
+
+def _pick_proactive(roll: float, count: int) -> str | None:
+    for _, kind, min_count in _CHECKIN_BANDS[bisect.bisect_right(_CHECKIN_BOUNDS, roll):]:
+        if count >= min_count:
+            return kind
+    return None
+
+
+async def _proactive_surprise(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    from core.agent import compose_surprise
+    try:
+        parts, files = await compose_surprise(uid)
+        logger.info("[proactive] Surprise for %s", uid)
+        await _send_parts(context, chat_id, parts)
+        state.add_messages(uid, "friend", parts)
+        if files:
+            await _send_files(context, chat_id, files)
+        return True
+    except Exception:
+        logger.exception("[surprise] Error")
+    return False
+
+
+async def _proactive_pattern(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    from core.agent import share_pattern_insight
+    try:
+        parts = await share_pattern_insight(uid)
+        if parts:
+            logger.info("[proactive] Pattern insight for %s", uid)
+            await _send_parts(context, chat_id, parts)
+            state.add_messages(uid, "friend", parts)
+            return True
+    except Exception:
+        logger.exception("[pattern] Error")
+    return False
+
+
+async def _proactive_thought(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    from core.agent import generate_inner_thought
+    try:
+        parts = await generate_inner_thought(uid)
+        if parts:
+            logger.info("[proactive] Inner thought for %s", uid)
+            if random.random() < 0.15:
+                combined = " ".join(parts)
+                voiced = await _send_as_voice_or_text(context, chat_id, combined)
+                if voiced:
+                    state.add_messages(uid, "friend", parts)
+                    return True
+            await _send_parts(context, chat_id, parts)
+            state.add_messages(uid, "friend", parts)
+            return True
+    except Exception:
+        logger.exception("[thought] Error")
+    return False
+
+
+async def _proactive_followup(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    from core.agent import proactive_followup
+    try:
+        parts = await proactive_followup(uid)
+        if parts:
+            logger.info("[proactive] Follow-up research for %s", uid)
+            await _send_parts(context, chat_id, parts)
+            state.add_messages(uid, "friend", parts)
+            return True
+    except Exception:
+        logger.exception("[followup] Error")
+    return False
+
+
+_PROACTIVE = {
+    "surprise": _proactive_surprise,
+    "pattern": _proactive_pattern,
+    "thought": _proactive_thought,
+    "followup": _proactive_followup,
+}
 
 
 async def _do_checkin(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    from core.agent import follow_up_on_promise, background_pass
     wait = random.uniform(180, 480)
     await asyncio.sleep(wait)
     history = state.get_history(uid)
     if not history:
         return
 
-    count = state.message_count(uid)
-    roll = random.random()
-
-    # 5% chance: surprise gift (requires 20+ messages)
-    if roll < 0.05 and count >= 20:
-        try:
-            parts, files = await compose_surprise(uid)
-            print(f"[proactive] Surprise for {uid}")
-            await _send_parts(context, chat_id, parts)
-            for p in parts:
-                state.add_message(uid, "friend", p)
-            if files:
-                await _send_files(context, chat_id, files)
-            return
-        except Exception as e:
-            print(f"[surprise] Error: {e}")
-
-    # 8% chance: pattern insight (requires 50+ messages)
-    elif roll < 0.13 and count >= 50:
-        try:
-            parts = await share_pattern_insight(uid)
-            if parts:
-                print(f"[proactive] Pattern insight for {uid}")
-                await _send_parts(context, chat_id, parts)
-                for p in parts:
-                    state.add_message(uid, "friend", p)
-                return
-        except Exception as e:
-            print(f"[pattern] Error: {e}")
-
-    # 8% chance: inner thought (requires 30+ messages)
-    elif roll < 0.21 and count >= 30:
-        try:
-            parts = await generate_inner_thought(uid)
-            if parts:
-                print(f"[proactive] Inner thought for {uid}")
-                if random.random() < 0.15:
-                    combined = " ".join(parts)
-                    voiced = await _send_as_voice_or_text(context, chat_id, combined)
-                    if voiced:
-                        for p in parts:
-                            state.add_message(uid, "friend", p)
-                        return
-                await _send_parts(context, chat_id, parts)
-                for p in parts:
-                    state.add_message(uid, "friend", p)
-                return
-        except Exception as e:
-            print(f"[thought] Error: {e}")
-
-    # 10% chance: proactive follow-up
-    elif roll < 0.31 and count >= 10:
-        try:
-            parts = await proactive_followup(uid)
-            if parts:
-                print(f"[proactive] Follow-up research for {uid}")
-                await _send_parts(context, chat_id, parts)
-                for p in parts:
-                    state.add_message(uid, "friend", p)
-                return
-        except Exception as e:
-            print(f"[followup] Error: {e}")
+    kind = _pick_proactive(random.random(), state.message_count(uid))
+    if kind and await _PROACTIVE[kind](uid, chat_id, context):
+        return
 
     # 50% chance: follow up on a promise
     promises = state.get_promises(uid)
     if promises and random.random() < 0.5:
-        promise = random.choice(promises)
+        promise = promises[random.randrange(len(promises))]
         parts = await follow_up_on_promise(history, promise)
-        print(f"[proactive] Promise follow-up for {uid}")
+        logger.info("[proactive] Promise follow-up for %s", uid)
         await _send_parts(context, chat_id, parts)
-        for p in parts:
-            state.add_message(uid, "friend", p)
+        state.add_messages(uid, "friend", parts)
         return
 
-    # Regular check-in (mood-aware)
-    parts = await checkin(history, user_id=uid)
+    # Regular check-in (mood-aware); the same call also picks up new promises
+    result = await background_pass(history, user_id=uid)
+    _store_promises(uid, result["promises"])
+    parts = result["checkin"]
     if parts:
-        print(f"[proactive] Check-in for {uid}")
+        logger.info("[proactive] Check-in for %s", uid)
         await _send_parts(context, chat_id, parts)
-        for p in parts:
-            state.add_message(uid, "friend", p)
+        state.add_messages(uid, "friend", parts)
 
 
 # --------------- Sticker Handling ---------------
 
 async def handle_sticker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle incoming sticker — classify, store, and reply."""
+    from core.agent import respond, classify_sticker_emotion
     if not _is_owner(update):
         return
     uid = _user_id(update)
@@ -522,7 +657,7 @@ async def handle_sticker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state.add_sticker(uid, sticker.file_id, emotion)
     state.add_message(uid, "user", f"[sticker: {emoji}]", "sticker")
 
-    typing_task = asyncio.create_task(_keep_typing(context, chat_id))
+    typing_task = asyncio.create_task(_keep_typing(context.bot, chat_id, _TYPING_GRACE))
     try:
         history = state.get_history(uid)
         parts, files = await respond(history[:-1], f"[User sent a sticker with emoji {emoji}, feeling: {emotion}]", user_id=uid)
@@ -530,8 +665,7 @@ async def handle_sticker(update: Update, context: ContextTypes.DEFAULT_TYPE):
         typing_task.cancel()
 
     await _send_parts(context, chat_id, parts)
-    for p in parts:
-        state.add_message(uid, "friend", p)
+    state.add_messages(uid, "friend", parts)
 
     if files:
         await _send_files(context, chat_id, files)
@@ -540,10 +674,9 @@ async def handle_sticker(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def _maybe_send_sticker(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE, parts: list[str]):
-    """15% chance to respond with a sticker that matches the emotion of the reply."""
+    """Respond with a sticker that matches the emotion of the reply (caller rolls the dice)."""
+    from core.agent import pick_response_emotion
     try:
-        if random.random() > 0.15:
-            return
         emotions = state.get_all_sticker_emotions(uid)
         if not emotions:
             return
@@ -556,14 +689,15 @@ async def _maybe_send_sticker(uid: str, chat_id: int, context: ContextTypes.DEFA
         chosen = random.choice(stickers)
         await asyncio.sleep(random.uniform(0.5, 1.5))
         await context.bot.send_sticker(chat_id, chosen["file_id"])
-    except Exception as e:
-        print(f"[sticker] Error sending sticker: {e}")
+    except Exception:
+        logger.exception("[sticker] Error sending sticker")
 
 
 # --------------- Event Extraction ---------------
 
 async def _extract_events(uid: str):
     """Extract time-bound events from recent conversation and store them."""
+    from core.agent import extract_events as agent_extract_events
     try:
         history = state.get_history(uid, limit=20)
         events = await agent_extract_events(history)
@@ -573,9 +707,47 @@ async def _extract_events(uid: str):
             original = e.get("original", "")
             if desc and date:
                 state.add_event(uid, desc, date, original)
-                print(f"[event] Stored for {uid}: {desc} on {date}")
-    except Exception as e:
-        print(f"[event] Extraction error for {uid}: {e}")
+                logger.info("[event] Stored for %s: %s on %s", uid, desc, date)
+    except Exception:
+        logger.exception("[event] Extraction error for %s", uid)
+
+
+# --------------- Background Queue ---------------
+
+_BG_JOBS = {
+    "promises": _extract_promises,
+    "memory": _update_memory,
+    "events": _extract_events,
+}
+_bg_queues: dict[str, asyncio.Queue] = {}
+_bg_pending: dict[str, set[str]] = {}
+_bg_workers: dict[str, asyncio.Task] = {}  # strong refs; the loop only holds weak ones
+
+
+def _enqueue_bg(uid: str, job: str):
+    """Queue a background extractor for uid; duplicates of a still-pending job are dropped."""
+    pending = _bg_pending.setdefault(uid, set())
+    if job in pending:
+        return
+    pending.add(job)
+    q = _bg_queues.get(uid)
+    if q is None:
+        q = _bg_queues[uid] = asyncio.Queue()
+        _bg_workers[uid] = asyncio.create_task(_bg_worker(uid, q))
+    q.put_nowait(job)
+
+
+async def _bg_worker(uid: str, q: asyncio.Queue):
+    """Run one user's queued jobs one at a time, then exit once the queue drains."""
+    try:
+        while not q.empty():
+            job = q.get_nowait()
+            _bg_pending[uid].discard(job)
+            await _BG_JOBS[job](uid)
+    finally:
+        _bg_workers.pop(uid, None)
+        _bg_queues.pop(uid, None)
+        _bg_pending.pop(uid, None)
 
 
 # --------------- Forwarded Message Handling ---------------
@@ -596,20 +768,23 @@ async def handle_forwarded(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         return
 
-    if uid not in _forward_buffers:
-        _forward_buffers[uid] = []
-    _forward_buffers[uid].append({
+    _forward_buffers.setdefault(uid, []).append({
         "text": text,
         "from": getattr(update.message.forward_from, "first_name", "") if update.message.forward_from else "",
     })
 
-    if uid in _forward_timers and not _forward_timers[uid].done():
-        _forward_timers[uid].cancel()
-    _forward_timers[uid] = asyncio.create_task(_flush_forwards(uid, chat_id, context))
+    # No await between the check and the set, so this is atomic on the event loop
+    existing = _forward_timers.get(uid)
+    if existing and not existing.done():
+        existing.cancel()
+    task = asyncio.create_task(_flush_forwards(uid, chat_id, context))
+    _forward_timers[uid] = task
+    task.add_done_callback(lambda t: _forget_task(_forward_timers, uid, t))
 
 
 async def _flush_forwards(uid: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     """Wait 2 seconds for more forwards, then batch-process."""
+    from core.agent import respond
     await asyncio.sleep(2.0)
 
     messages = _forward_buffers.pop(uid, [])
@@ -623,7 +798,7 @@ async def _flush_forwards(uid: str, chat_id: int, context: ContextTypes.DEFAULT_
 
     state.add_message(uid, "user", f"[forwarded messages]\n{combined}", "forward")
 
-    typing_task = asyncio.create_task(_keep_typing(context, chat_id))
+    typing_task = asyncio.create_task(_keep_typing(context.bot, chat_id, _TYPING_GRACE))
     try:
         history = state.get_history(uid)
         prompt = f"The user forwarded you {len(messages)} message(s). Read them and respond naturally — maybe summarize, comment, or react:\n\n{combined}"
@@ -632,8 +807,7 @@ async def _flush_forwards(uid: str, chat_id: int, context: ContextTypes.DEFAULT_
         typing_task.cancel()
 
     await _send_parts(context, chat_id, parts)
-    for p in parts:
-        state.add_message(uid, "friend", p)
+    state.add_messages(uid, "friend", parts)
 
     if files:
         await _send_files(context, chat_id, files)
@@ -643,8 +817,81 @@ async def _flush_forwards(uid: str, chat_id: int, context: ContextTypes.DEFAULT_
 
 # --------------- Document Handling ---------------
 
+_SUPPORTED_DOC_EXTS = frozenset({
+    ".txt", ".md", ".csv", ".json", ".py", ".js", ".ts", ".html", ".xml", ".log", ".pdf", ".doc", ".docx",
+})
+_BINARY_DOC_EXTS = frozenset({".pdf", ".doc", ".docx"})  # need an extractor and a temp file
+
+
+def _supported_doc_filter():
+    """OR together one FileExtension filter per supported extension."""
+    combined = None
+    for ext in sorted(_SUPPORTED_DOC_EXTS):
+        f = filters.Document.FileExtension(ext[1:])
+        combined = f if combined is None else combined | f
+    return combined
+
+
+def _extract_pdf(path: str) -> str:
+    import fitz  # PyMuPDF
+    with fitz.open(path) as doc:
+        return "\n".join(p.get_text() for p in doc)
+
+
+def _extract_docx(path: str) -> str:
+    from docx import Document
+    return "\n".join(p.text for p in Document(path).paragraphs)
+
+
+_EXTRACT_TIMEOUT = 30  # seconds; a stuck extractor must not hold up the chat's queue
+
+
+async def _run_extractor(*cmd: str) -> str:
+    """Run a command-line text extractor; returns "" if it is missing, fails or times out."""
+    import subprocess
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return ""
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), _EXTRACT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("[file] %s timed out after %ss", cmd[0], _EXTRACT_TIMEOUT)
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        return ""
+    if proc.returncode != 0:
+        return ""
+    # Same cap as the old `| head -200`
+    return "\n".join(stdout.decode(errors="ignore").splitlines()[:200]).strip()
+
+
+async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle unsupported uploads by filename only — nothing is downloaded."""
+    from core.agent import respond
+    if not _is_owner(update):
+        return
+    uid = _user_id(update)
+    chat_id = update.effective_chat.id
+    state.set_chat_id(uid, chat_id)
+
+    filename = update.message.document.file_name or "unknown"
+    caption = update.message.caption or ""
+
+    state.add_message(uid, "user", f"[file: {filename}]", "file")
+    parts, files = await respond(state.get_history(uid)[:-1], f"[User sent a file: {filename}]" + (f" with caption: {caption}" if caption else ""), user_id=uid)
+    await _send_parts(context, chat_id, parts)
+    state.add_messages(uid, "friend", parts)
+
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle uploaded documents — extract text and let LLM summarize."""
+    from core.agent import respond
     if not _is_owner(update):
         return
     uid = _user_id(update)
@@ -654,51 +901,37 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     doc = update.message.document
     filename = doc.file_name or "unknown"
     caption = update.message.caption or ""
-
     ext = os.path.splitext(filename)[1].lower()
-    supported = {".txt", ".md", ".csv", ".json", ".py", ".js", ".ts", ".html", ".xml", ".log", ".pdf", ".doc", ".docx"}
-    if ext not in supported:
-        state.add_message(uid, "user", f"[file: {filename}]", "file")
-        parts, files = await respond(state.get_history(uid)[:-1], f"[User sent a file: {filename}]" + (f" with caption: {caption}" if caption else ""), user_id=uid)
-        await _send_parts(context, chat_id, parts)
-        for p in parts:
-            state.add_message(uid, "friend", p)
-        return
-
-    import tempfile
 
     file = await context.bot.get_file(doc.file_id)
     data = await file.download_as_bytearray()
 
     text_content = ""
     try:
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as f:
-            f.write(bytes(data))
-            tmp_path = f.name
-
-        if ext == ".pdf":
-            import subprocess
-            proc = await asyncio.create_subprocess_shell(
-                f'python3 -c "import fitz; doc=fitz.open(\'{tmp_path}\'); print(chr(10).join(p.get_text() for p in doc))" 2>/dev/null || '
-                f'strings "{tmp_path}" | head -200',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            )
-            stdout, _ = await proc.communicate()
-            text_content = stdout.decode(errors="ignore").strip()
-        elif ext in {".doc", ".docx"}:
-            import subprocess
-            proc = await asyncio.create_subprocess_shell(
-                f'textutil -convert txt -stdout "{tmp_path}" 2>/dev/null || strings "{tmp_path}" | head -200',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            )
-            stdout, _ = await proc.communicate()
-            text_content = stdout.decode(errors="ignore").strip()
+        if ext in _BINARY_DOC_EXTS:
+            # Extractors need a real path; plain-text formats decode straight from memory
+            with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as f:
+                f.write(data)
+                tmp_path = f.name
+            try:
+                if ext == ".doc":
+                    # Legacy .doc: textutil on macOS, strings elsewhere
+                    text_content = (
+                        await _run_extractor("textutil", "-convert", "txt", "-stdout", tmp_path)
+                        or await _run_extractor("strings", tmp_path)
+                    )
+                else:
+                    extract = _extract_pdf if ext == ".pdf" else _extract_docx
+                    try:
+                        text_content = (await asyncio.to_thread(extract, tmp_path)).strip()
+                    except Exception:
+                        text_content = await _run_extractor("strings", tmp_path)
+            finally:
+                os.unlink(tmp_path)
         else:
-            text_content = bytes(data).decode(errors="ignore")
-
-        os.unlink(tmp_path)
-    except Exception as e:
-        print(f"[document] Text extraction error: {e}")
+            text_content = data.decode(errors="ignore")
+    except Exception:
+        logger.exception("[document] Text extraction error")
         text_content = ""
 
     if len(text_content) > 6000:
@@ -709,7 +942,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     state.add_message(uid, "user", f"[document: {filename}]", "document")
 
-    typing_task = asyncio.create_task(_keep_typing(context, chat_id))
+    typing_task = asyncio.create_task(_keep_typing(context.bot, chat_id, _TYPING_GRACE))
     try:
         history = state.get_history(uid)
         prompt = f"The user sent a document '{filename}'."
@@ -721,8 +954,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         typing_task.cancel()
 
     await _send_parts(context, chat_id, parts)
-    for p in parts:
-        state.add_message(uid, "friend", p)
+    state.add_messages(uid, "friend", parts)
 
     if files:
         await _send_files(context, chat_id, files)
@@ -732,70 +964,74 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --------------- Daily Greeting ---------------
 
+_http_client = None  # httpx.AsyncClient shared across one greeting sweep
+
+
 async def _fetch_weather(city: str) -> str:
-    if not city:
+    if not city or _http_client is None:
         return ""
     try:
-        import subprocess
         import urllib.parse
         encoded = urllib.parse.quote(city)
-        proc = await asyncio.create_subprocess_shell(
-            f'curl -s "wttr.in/{encoded}?format=%l:+%c+%t+%h+%w&lang=zh" --max-time 5',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        resp = await _http_client.get(
+            f"https://wttr.in/{encoded}",
+            params={"format": "%l: %c %t %h %w", "lang": "zh"},
         )
-        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=8)
-        return stdout.decode().strip()
-    except Exception as e:
-        print(f"[weather] Error: {e}")
+        return resp.text.strip()
+    except Exception:
+        logger.exception("[weather] Error")
         return ""
 
 
-def _extract_city_from_profile(profile: str) -> str:
-    if not profile:
-        return ""
-    for line in profile.split("\n"):
-        if "所在地" in line:
-            city = line.split(":", 1)[-1].strip().split("：", 1)[-1].strip()
-            return city if city and city != "..." else ""
-    return ""
-
-
 async def _daily_greeting(app: Application):
     """Send morning greeting to all known users."""
+    from core.agent import compose_greeting
+    import httpx
+    global _http_client
+    # One pooled keep-alive client for all weather lookups in this sweep
+    _http_client = httpx.AsyncClient(
+        timeout=5,
+        limits=httpx.Limits(max_connections=32),
+        headers={"User-Agent": "curl/8.0"},
+    )
     try:
         all_users = state.get_all_chat_ids()
         today = datetime.now().strftime("%Y-%m-%d")
-
-        for uid, chat_id in all_users:
-            try:
-                profile = state.get_user_profile(uid) or ""
-                city = _extract_city_from_profile(profile)
-                weather = await _fetch_weather(city) if city else ""
-                events = state.get_due_events(uid, today)
-                parts = await compose_greeting(uid, weather=weather, events=events)
-
-                await _send_parts_via_bot(app.bot, chat_id, parts)
-                for p in parts:
-                    state.add_message(uid, "friend", p)
-
-                for e in events:
-                    state.mark_event_triggered(e["id"])
-
-                print(f"[greeting] Sent morning greeting to {uid}")
-            except Exception as e:
-                print(f"[greeting] Error for {uid}: {e}")
-    except Exception as e:
-        print(f"[greeting] Loop error: {e}")
-
-
-async def _send_parts_via_bot(bot, chat_id: int, parts: list[str]):
-    for i, text in enumerate(parts):
-        await bot.send_chat_action(chat_id, "typing")
-        delay = max(0.5, min(3.0, len(text) * 0.12)) + random.uniform(-0.2, 0.4)
-        await asyncio.sleep(max(0.3, delay))
-        await bot.send_message(chat_id, text)
-        if i < len(parts) - 1:
-            await asyncio.sleep(random.uniform(0.2, 0.6))
+        # Cap concurrent LLM/Telegram calls; users sharing a city share one lookup
+        sem = asyncio.Semaphore(8)
+        weather_tasks: dict[str, asyncio.Task] = {}
+
+        async def _greet_one(uid: str, chat_id: int):
+            async with sem:
+                try:
+                    city = state.get_city(uid)
+                    weather = ""
+                    if city:
+                        if city not in weather_tasks:
+                            weather_tasks[city] = asyncio.create_task(_fetch_weather(city))
+                        weather = await weather_tasks[city]
+                    events = state.get_due_events(uid, today)
+                    parts = await compose_greeting(uid, weather=weather, events=events)
+
+                    await _deliver(app.bot, chat_id, parts)
+                    state.add_messages(uid, "friend", parts)
+
+                    for e in events:
+                        state.mark_event_triggered(e["id"])
+
+                    logger.info("[greeting] Sent morning greeting to %s", uid)
+                except Exception:
+                    logger.exception("[greeting] Error for %s", uid)
+
+        await asyncio.gather(
+            *(_greet_one(uid, chat_id) for uid, chat_id in all_users),
+            return_exceptions=True,
+        )
+    except Exception:
+        logger.exception("[greeting] Loop error")
+    finally:
+        await _http_client.aclose()
+        _http_client = None
 
 
 async def _daily_greeting_loop(app: Application):
@@ -806,18 +1042,81 @@ async def _daily_greeting_loop(app: Application):
         if now >= target:
             target += timedelta(days=1)
         wait_seconds = (target - now).total_seconds()
-        print(f"[greeting] Next greeting in {wait_seconds/3600:.1f} hours")
+        logger.info("[greeting] Next greeting in %.1f hours", wait_seconds / 3600)
         await asyncio.sleep(wait_seconds)
         await _daily_greeting(app)
 
 
 async def _post_init(app: Application):
     asyncio.create_task(_daily_greeting_loop(app))
-    print("[greeting] Daily greeting loop started")
+    logger.info("[greeting] Daily greeting loop started")
+
+
+async def _post_shutdown(app: Application):
+    from core.agent import aclose
+    await aclose()
+
+
+# --------------- Per-chat ordering ---------------
+
+_CHAT_QUEUE_MAX = 32  # back-pressure: beyond this backlog, new updates wait for a free slot
+_chat_queues: dict[int, asyncio.Queue] = {}
+_chat_workers: dict[int, asyncio.Task] = {}
+
+
+def _per_chat(handler):
+    """Run a chat's updates one at a time in arrival order; different chats run concurrently."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        if chat is None:
+            return await handler(update, context)
+        q = _chat_queues.get(chat.id)
+        if q is None:
+            q = _chat_queues[chat.id] = asyncio.Queue(maxsize=_CHAT_QUEUE_MAX)
+        if q.full():
+            logger.warning("[bot] Chat %s backlog full, waiting for a free slot", chat.id)
+        # A full queue always has a live worker draining it, so this wait ends
+        await q.put((handler, update, context))
+        if chat.id not in _chat_workers:
+            _chat_workers[chat.id] = asyncio.create_task(_chat_worker(chat.id, q))
+    return wrapper
+
+
+async def _chat_worker(chat_id: int, q: asyncio.Queue):
+    """Drain one chat's queue serially, then exit."""
+    try:
+        while not q.empty():
+            handler, update, context = q.get_nowait()
+            try:
+                await handler(update, context)
+            except Exception:
+                logger.exception("[bot] Handler error in chat %s", chat_id)
+    finally:
+        _chat_workers.pop(chat_id, None)
+        _chat_queues.pop(chat_id, None)
 
 
 # --------------- Factory ---------------
 
+def _setup_logging():
+    """Route bot and core logs through a queue so stdout I/O happens off the event loop."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue: queue.Queue = queue.Queue(-1)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream)
+    _log_listener.start()
+    handler = logging.handlers.QueueHandler(log_queue)
+    # The agent, state and cache modules log under "core.*"; same queue, same format
+    for log in (logger, logging.getLogger("core")):
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        log.propagate = False
+
+
 def create_bot(token: str, owner_id: str = None) -> Application:
     """Create and configure the Telegram bot application.
 
@@ -826,19 +1125,29 @@ def create_bot(token: str, owner_id: str = None) -> Application:
         owner_id: If set, only this Telegram user ID can use the bot.
                   None = allow all users (module mode default).
     """
-    global _owner_id
+    global _owner_id, state
     _owner_id = owner_id
-
-    app = Application.builder().token(token).post_init(_post_init).build()
-    app.add_handler(CommandHandler("start", handle_start))
-    app.add_handler(CommandHandler("memory", handle_memory))
-    app.add_handler(CommandHandler("forget", handle_forget))
-    app.add_handler(MessageHandler(filters.Sticker.ALL, handle_sticker))
-    app.add_handler(MessageHandler(filters.FORWARDED, handle_forwarded))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.FORWARDED, handle_text))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    app.add_handler(MessageHandler(filters.VOICE, handle_voice))
-    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    state = UserState()
+    _setup_logging()
+
+    # Updates run concurrently; _per_chat restores in-order handling within each chat
+    app = (
+        Application.builder().token(token)
+        .concurrent_updates(True)
+        .post_init(_post_init).post_shutdown(_post_shutdown)
+        .build()
+    )
+    app.add_handler(CommandHandler("start", _per_chat(handle_start)))
+    app.add_handler(CommandHandler("memory", _per_chat(handle_memory)))
+    app.add_handler(CommandHandler("forget", _per_chat(handle_forget)))
+    app.add_handler(MessageHandler(filters.Sticker.ALL, _per_chat(handle_sticker)))
+    app.add_handler(MessageHandler(filters.FORWARDED, _per_chat(handle_forwarded)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.FORWARDED, _per_chat(handle_text)))
+    app.add_handler(MessageHandler(filters.PHOTO, _per_chat(handle_photo)))
+    app.add_handler(MessageHandler(filters.VOICE, _per_chat(handle_voice)))
+    doc_filter = _supported_doc_filter()
+    app.add_handler(MessageHandler(doc_filter, _per_chat(handle_document)))
+    app.add_handler(MessageHandler(filters.Document.ALL & ~doc_filter, _per_chat(handle_file)))
     return app
 
 
@@ -846,7 +1155,6 @@ def create_bot(token: str, owner_id: str = None) -> Application:
 
 def main():
     """Run the bot standalone (loads .env, requires TELEGRAM_BOT_TOKEN)."""
-    import sys
     from dotenv import load_dotenv
     load_dotenv(os.path.join(os.path.dirname(__file__), "..", "telegram", ".env"))
 
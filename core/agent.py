@@ -4,44 +4,227 @@ from __future__ import annotations
 import os
 import json
 import asyncio
-import urllib.request
+import logging
+import functools
+import hashlib
+import importlib.util
 import base64
+import binascii
 import re
+import random
+import string
+import time
 from datetime import datetime
-from openai import AsyncOpenAI
+from html.parser import HTMLParser
+from itertools import islice
+from typing import AsyncIterator
+
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+
+from core.cache import response_cache, similar_cache, disk_cache
+from core.state import UserState, format_transcript
+
+logger = logging.getLogger("core.agent")
+
+try:
+    import orjson
+    _loads = orjson.loads
+
+    def _dumps(obj) -> str:
+        # Sorted keys: stored meta blobs are byte-identical for identical content
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, sort_keys=True)
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    from selectolax.parser import HTMLParser as _FastHTMLParser
+except ImportError:
+    _FastHTMLParser = None
+
+try:
+    from duckduckgo_search import DDGS
+except ImportError:
+    DDGS = None
+
+try:
+    import pybase64 as _b64  # SIMD base64, noticeably faster on photo payloads
+except ImportError:
+    _b64 = base64
+
+try:
+    from app import config as _app_config
+except ImportError:
+    _app_config = None
+
+try:
+    from menubar.tools import TOOL_DEFINITIONS as _LOCAL_TOOL_DEFS, execute_tool as _execute_local
+except ImportError:
+    _LOCAL_TOOL_DEFS, _execute_local = [], None
 
 MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
-MILESTONE_COUNTS = {20, 50, 100, 200}
+DEBUG = bool(os.getenv("AGENT_DEBUG"))
+MILESTONE_COUNTS = frozenset({20, 50, 100, 200})
+_MAX_MILESTONE = max(MILESTONE_COUNTS)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+_FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]*?)```")
+_SPLIT = re.compile(r"\s*\|\|\|\s*")
+_DATA_URL_RE = re.compile(r"data:image/[^;]+;base64,([A-Za-z0-9+/=\s]+)")
+_B64_WS = str.maketrans("", "", " \t\r\n")  # one C-level pass to drop wrapping whitespace
 
 _client = None
+_HTTP2 = importlib.util.find_spec("h2") is not None
 
 
 def get_client() -> AsyncOpenAI:
     global _client
     if _client is None:
+        # One pooled transport for every LLM call: keep-alive connections, and
+        # HTTP/2 multiplexing when the optional h2 package is installed.
+        # retries=2 re-attempts failed connects only; request-level retries live in _call
+        transport = httpx.AsyncHTTPTransport(
+            http2=_HTTP2,
+            retries=2,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+        http_client = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(60.0, connect=10.0))
         proxy_url = os.getenv("PROXY_URL", "")
         if proxy_url:
             # Use our proxy — device_id is the auth token
             _client = AsyncOpenAI(
                 base_url=proxy_url,
                 api_key=os.getenv("DEVICE_ID", "anonymous"),
+                http_client=http_client,
             )
         else:
             # Direct OpenAI connection (fallback)
-            _client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+            _client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
     return _client
 
 
+_STATE: UserState | None = None
+
+
+def _state() -> UserState:
+    """The one UserState shared by every agent function — created on first use, not at import."""
+    global _STATE
+    if _STATE is None:
+        _STATE = UserState()
+    return _STATE
+
+
+async def aclose():
+    """Close the pooled HTTP clients; call once on shutdown."""
+    global _client, _http
+    if _client is not None:
+        await _client.close()
+        _client = None
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+_RETRYABLE = (RateLimitError, APIConnectionError, InternalServerError)
+CALL_RETRIES = 3
+# Route calls that share a system prompt to the same OpenAI prompt-cache shard;
+# set PROMPT_CACHE_KEYS=0 for backends that reject unknown request fields.
+PROMPT_CACHE_KEYS = os.getenv("PROMPT_CACHE_KEYS", "1") != "0"
+
+
+@functools.lru_cache(maxsize=64)
+def _prompt_cache_key(system: str) -> str:
+    return "sys-" + hashlib.blake2b(system.encode(), digest_size=8).hexdigest()
+
+
+async def _call(messages: list[dict], *, temperature: float = 0.9, **kwargs):
+    """chat.completions.create with the shared model and backoff on transient errors.
+
+    Returns whatever the SDK returns (a stream when stream=True). Only the request
+    itself is retried; a stream that fails midway is left to the caller.
+    """
+    head = messages[0].get("content") if messages[0]["role"] == "system" else None
+    if PROMPT_CACHE_KEYS and isinstance(head, str) and "extra_body" not in kwargs:
+        kwargs["extra_body"] = {"prompt_cache_key": _prompt_cache_key(head)}
+    for attempt in range(CALL_RETRIES + 1):
+        try:
+            return await get_client().chat.completions.create(
+                model=MODEL, temperature=temperature, messages=messages, **kwargs,
+            )
+        except _RETRYABLE as e:
+            if attempt == CALL_RETRIES:
+                raise
+            delay = 0.5 * 2 ** attempt + random.random() * 0.5
+            if DEBUG:
+                logger.warning("[agent] %s, retrying in %.1fs", type(e).__name__, delay)
+            await asyncio.sleep(delay)
+
+
+CACHE_MAX_TEMPERATURE = 0.7  # hotter calls are meant to vary; never replay them
+DISK_CACHE_MAX_TEMPERATURE = 0.6  # only near-deterministic background calls are kept across restarts
+
+
 async def _chat(system: str, user_msg: str, temperature: float = 0.8) -> str:
-    response = await get_client().chat.completions.create(
-        model=MODEL,
+    cacheable = temperature <= CACHE_MAX_TEMPERATURE
+    persist = temperature <= DISK_CACHE_MAX_TEMPERATURE
+    key = response_cache.key(MODEL, temperature, system, user_msg) if cacheable else None
+    if cacheable:
+        cached = response_cache.get(key)
+        if cached is None and persist:
+            cached = disk_cache.get(key)
+            if cached is not None:
+                response_cache.set(key, cached)
+        if cached is not None:
+            return cached
+    response = await _call(
+        [
+            _SYS_MSG if system is SYSTEM else {"role": "system", "content": system},
+            {"role": "user", "content": user_msg},
+        ],
         temperature=temperature,
-        messages=[
-            {"role": "system", "content": system},
+    )
+    content = response.choices[0].message.content or ""
+    if cacheable:
+        response_cache.set(key, content)
+        if persist:
+            disk_cache.set(key, content)
+    return content
+
+
+async def _chat_stream(system: str, user_msg: str, temperature: float = 0.8) -> AsyncIterator[str]:
+    """Like _chat, but streams and yields each |||-separated part as soon as it is complete."""
+    stream = await _call(
+        [
+            _SYS_MSG if system is SYSTEM else {"role": "system", "content": system},
             {"role": "user", "content": user_msg},
         ],
+        temperature=temperature,
+        stream=True,
     )
-    return response.choices[0].message.content or ""
+    buf = ""
+    try:
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            buf += chunk.choices[0].delta.content
+            if "|||" in buf:
+                *done, buf = _SPLIT.split(buf)
+                for piece in done:
+                    piece = piece.strip()
+                    if piece:
+                        yield piece
+    finally:
+        await stream.close()
+    piece = buf.strip()
+    if piece:
+        yield piece
 
 
 # --------------- System Prompt ---------------
@@ -151,6 +334,28 @@ Example:
 IMPORTANT: Keep each message short. One or two sentences max. Better to send 5 short messages than 1 long one."""
 
 
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    try:
+        return tiktoken.encoding_for_model(MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+    """Token count for `text` under MODEL's encoding; a rough estimate without tiktoken."""
+    if tiktoken is not None:
+        return len(_encoding().encode(text))
+    # ~4 ASCII chars per token; CJK is roughly one token per character
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+# Fixed prefix of every reply call — built once at import.
+_SYS_MSG = {"role": "system", "content": SYSTEM}
+
+
 # --------------- Cloud Tools (always available) ---------------
 
 CLOUD_TOOLS = [
@@ -199,28 +404,62 @@ CLOUD_TOOLS = [
 ]
 
 
-def _get_enabled_tools() -> list[str]:
-    """Get enabled local tools from config."""
+_CONFIG_PATH = os.path.expanduser("~/.protagonist/config.json")
+
+
+@functools.lru_cache(maxsize=1)
+def _config_at(mtime_ns: int) -> dict:
+    with open(_CONFIG_PATH, "rb") as f:
+        return _loads(f.read())
+
+
+def _load_config() -> dict:
+    """config.json as a dict, parsed once per mtime ({} if missing or unreadable). Don't mutate it."""
     try:
-        from app import config
-        return config.get_enabled_tools()
-    except ImportError:
-        pass
-    # Fallback: read config.json directly
+        return _config_at(os.stat(_CONFIG_PATH).st_mtime_ns)
+    except Exception:
+        return {}
+
+
+def _read_enabled_tools() -> frozenset[str]:
+    """Enabled tools straight from config.json, recomputed only when its mtime changes."""
     try:
-        cfg_path = os.path.expanduser("~/.protagonist/config.json")
-        with open(cfg_path, "r") as f:
-            tools = json.load(f).get("tools", {})
-        return [name for name, enabled in tools.items() if enabled]
+        return _enabled_at(os.stat(_CONFIG_PATH).st_mtime_ns)
     except Exception:
-        return []
+        return frozenset()
+
+
+@functools.lru_cache(maxsize=1)
+def _enabled_at(mtime_ns: int) -> frozenset[str]:
+    tools = _config_at(mtime_ns).get("tools", {})
+    return frozenset(name for name, enabled in tools.items() if enabled)
+
+
+def _enabled() -> frozenset[str]:
+    """Enabled local tools as a frozenset; cached until the config changes."""
+    if _app_config is not None:
+        return _app_config.enabled_tools_set()
+    return _read_enabled_tools()
+
+
+@functools.lru_cache(maxsize=8)
+def _tools_snapshot(enabled: frozenset[str]) -> list[dict]:
+    """CLOUD_TOOLS plus the enabled local tool definitions. Callers must not mutate it."""
+    return _sorted_tools(CLOUD_TOOLS + [t for t in _LOCAL_TOOL_DEFS if t["function"]["name"] in enabled])
+
+
+def _sorted_tools(tools: list[dict]) -> list[dict]:
+    """Dedupe by function name (last wins) and sort, so the tools block is byte-stable across turns."""
+    by_name = {t["function"]["name"]: t for t in tools}
+    return [by_name[name] for name in sorted(by_name)]
 
 
 async def _execute_local_tool(name: str, args: dict) -> str:
     """Execute a local tool directly (in-process)."""
+    if _execute_local is None:
+        return "Local tool error: local tools are not available"
     try:
-        from menubar.tools import execute_tool
-        return await execute_tool(name, args)
+        return await _execute_local(name, args)
     except Exception as e:
         return f"Local tool error: {e}"
 
@@ -233,12 +472,34 @@ def _get_openrouter_key() -> str:
     key = os.getenv("OPENROUTER_API_KEY", "")
     if key:
         return key
-    try:
-        cfg_path = os.path.expanduser("~/.protagonist/config.json")
-        with open(cfg_path, "r") as f:
-            return json.load(f).get("openrouter_api_key", "")
-    except Exception:
-        return ""
+    return _load_config().get("openrouter_api_key", "")
+
+
+_B64_CHUNK = 1 << 16  # multiple of 4, so every slice decodes on its own
+
+
+OUTPUT_DIR = "/tmp/protagonist_docs"
+
+
+@functools.lru_cache(maxsize=1)
+def _output_dir() -> str:
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    return OUTPUT_DIR
+
+
+def _output_path(kind: str, ext: str) -> str:
+    """Unique file path for a generated image/voice; concurrent calls in the same ms don't collide."""
+    ts = int(datetime.now().timestamp() * 1000)
+    return os.path.join(_output_dir(), f"{kind}_{ts}_{random.getrandbits(24):06x}.{ext}")
+
+
+def _write_b64(path: str, b64: str):
+    """Decode base64 into a file slice by slice, never holding the whole decoded image."""
+    if any(c in b64 for c in " \t\r\n"):
+        b64 = b64.translate(_B64_WS)
+    with open(path, "wb") as f:
+        for i in range(0, len(b64), _B64_CHUNK):
+            f.write(binascii.a2b_base64(b64[i:i + _B64_CHUNK]))
 
 
 async def _generate_image(prompt: str) -> str:
@@ -247,8 +508,6 @@ async def _generate_image(prompt: str) -> str:
     if not api_key:
         return "Image generation unavailable (no OpenRouter API key configured)"
 
-    import httpx
-
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
@@ -262,14 +521,14 @@ async def _generate_image(prompt: str) -> str:
     }
 
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            resp = await client.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=body,
-            )
-            resp.raise_for_status()
-            data = resp.json()
+        resp = await _get_http().post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            headers=headers,
+            json=body,
+            timeout=60,
+        )
+        resp.raise_for_status()
+        data = _loads(resp.content)
 
         msg = data.get("choices", [{}])[0].get("message", {})
 
@@ -309,19 +568,16 @@ async def _generate_image(prompt: str) -> str:
         if not img_b64:
             content = msg.get("content", "")
             if isinstance(content, str):
-                m = re.search(r'data:image/[^;]+;base64,([A-Za-z0-9+/=\s]+)', content)
+                m = _DATA_URL_RE.search(content)
                 if m:
-                    img_b64 = m.group(1).replace("\n", "").replace(" ", "")
+                    img_b64 = m.group(1)
 
         if not img_b64:
             return "Image generation failed — no image in response"
 
         # Save to temp file
-        os.makedirs("/tmp/protagonist_docs", exist_ok=True)
-        ts = int(datetime.now().timestamp() * 1000)
-        path = f"/tmp/protagonist_docs/image_{ts}.png"
-        with open(path, "wb") as f:
-            f.write(base64.b64decode(img_b64))
+        path = _output_path("image", "png")
+        await asyncio.to_thread(_write_b64, path, img_b64)
 
         return f"FILE:{path}\n已生成图片"
 
@@ -329,57 +585,172 @@ async def _generate_image(prompt: str) -> str:
         return f"Image generation error: {e}"
 
 
+_http: httpx.AsyncClient | None = None
+
+
+def _get_http() -> httpx.AsyncClient:
+    """Shared client for web tools — keeps connections (and TLS sessions) alive."""
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            http2=_HTTP2,
+            timeout=15,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            follow_redirects=True,
+            headers={"User-Agent": "Mozilla/5.0"},
+        )
+    return _http
+
+
+class _TextExtractor(HTMLParser):
+    """Collect visible text from HTML, one line per block element."""
+
+    _SKIP = frozenset({"script", "style", "noscript", "template", "svg", "head"})
+    _BLOCK = frozenset({
+        "p", "div", "br", "li", "tr", "td", "th", "ul", "ol", "table", "section", "article",
+        "header", "footer", "nav", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote",
+    })
+
+    def __init__(self):
+        super().__init__()
+        self.chunks: list[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP:
+            self._skip_depth += 1
+        elif tag in self._BLOCK:
+            self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self._BLOCK:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.chunks.append(data)
+
+
+def _html_to_text(html: str, max_lines: int) -> str:
+    """HTML → plain text, first max_lines non-blank lines (selectolax if installed)."""
+    if _FastHTMLParser is not None:
+        tree = _FastHTMLParser(html)
+        tree.strip_tags(["script", "style", "noscript", "template", "svg"])
+        root = tree.body or tree.root
+        text = root.text(separator="\n") if root else ""
+    else:
+        parser = _TextExtractor()
+        parser.feed(html)
+        parser.close()
+        text = "".join(parser.chunks)
+    lines = []
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if line:
+            lines.append(line)
+            if len(lines) >= max_lines:
+                break
+    return "\n".join(lines)
+
+
+SEARCH_HEDGE_DELAY = 1.75  # ~p90 proxy latency; fallbacks only join when the proxy is slow
+SEARCH_TIMEOUT = 15  # same overall budget as the old serial chain's HTTP timeout
+
+
+async def _search_proxy_checked(query: str) -> str:
+    result = await _search_via_proxy(query)
+    if "unavailable" in result.lower() or "error" in result.lower():
+        return ""
+    return result
+
+
+async def _search_ddg(query: str) -> str:
+    """duckduckgo-search library (reliable local fallback)."""
+    if DDGS is None:
+        return ""
+    try:
+        results = await asyncio.to_thread(lambda: list(DDGS().text(query, max_results=5)))
+    except Exception as e:
+        logger.warning("[search] duckduckgo-search fallback error: %s", e)
+        return ""
+    return "\n\n".join(f"{r['title']}\n{r['body']}\n{r['href']}" for r in results)
+
+
+async def _search_html(query: str) -> str:
+    """Scrape DuckDuckGo's HTML endpoint (last resort)."""
+    try:
+        r = await _get_http().get("https://html.duckduckgo.com/html/", params={"q": query})
+        return _html_to_text(r.text, max_lines=80)
+    except Exception as e:
+        logger.warning("[search] html fallback error: %s", e)
+        return ""
+
+
+async def _hedged_search(query: str) -> str:
+    """Proxy → DDG library → DDG HTML, hedged: each backend starts when the previous one
+    fails or after SEARCH_HEDGE_DELAY, and the first non-empty result wins."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SEARCH_TIMEOUT
+    backends = iter((_search_proxy_checked, _search_ddg, _search_html))
+    pending: set[asyncio.Task] = set()
+    order: dict[asyncio.Task, int] = {}
+    more = True
+
+    def launch():
+        nonlocal more
+        fn = next(backends, None)
+        if fn is None:
+            more = False
+        else:
+            task = asyncio.create_task(fn(query))
+            order[task] = len(order)
+            pending.add(task)
+
+    launch()
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=min(SEARCH_HEDGE_DELAY, remaining) if more else remaining,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            pending.difference_update(done)
+            # Launch order is preference order: the proxy wins a tie with a fallback
+            for task in sorted(done, key=order.__getitem__):
+                if not task.exception() and task.result():
+                    return task.result()
+            # Nothing usable yet: either the hedge delay passed or a backend failed
+            launch()
+        return ""
+    finally:
+        for task in pending:
+            task.cancel()
+
+
 async def _execute_cloud_tool(name: str, args: dict) -> str:
     """Execute a cloud-side tool, or route to local tool."""
     # Check if this is a local tool
-    enabled = _get_enabled_tools()
-    if name in enabled:
+    if name in _enabled():
         return await _execute_local_tool(name, args)
 
-    import subprocess
-
     if name == "web_search":
         query = args.get("query", "")
-        # 1. Proxy search
-        result = await asyncio.to_thread(_search_via_proxy_sync, query)
-        if result and "unavailable" not in result.lower() and "error" not in result.lower():
-            return result
-        # 2. duckduckgo-search library (reliable local fallback)
-        try:
-            from duckduckgo_search import DDGS
-            results = await asyncio.to_thread(
-                lambda: list(DDGS().text(query, max_results=5))
-            )
-            if results:
-                lines = [f"{r['title']}\n{r['body']}\n{r['href']}" for r in results]
-                return "\n\n".join(lines)
-        except Exception as e:
-            print(f"  [search] duckduckgo-search fallback error: {e}")
-        # 3. curl fallback (last resort)
-        import urllib.parse
-        encoded = urllib.parse.quote_plus(query)
-        proc = await asyncio.create_subprocess_shell(
-            f'curl -sL "https://html.duckduckgo.com/html/?q={encoded}" '
-            f'-H "User-Agent: Mozilla/5.0" '
-            f'| textutil -stdin -stdout -format html -convert txt 2>/dev/null '
-            f'| head -80',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        )
-        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=15)
-        result = stdout.decode().strip()
+        result = await _hedged_search(query)
         return result if result else f"No results for '{query}'"
 
     elif name == "read_webpage":
         url = args.get("url", "")
-        proc = await asyncio.create_subprocess_shell(
-            f'curl -sL "{url}" '
-            f'-H "User-Agent: Mozilla/5.0" '
-            f'| textutil -stdin -stdout -format html -convert txt 2>/dev/null '
-            f'| head -120',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        )
-        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=15)
-        result = stdout.decode().strip()
+        try:
+            r = await _get_http().get(url)
+            result = _html_to_text(r.text, max_lines=120)
+        except Exception as e:
+            logger.warning("[read] fetch error: %s", e)
+            result = ""
         return result if result else "Could not read webpage"
 
     elif name == "generate_image":
@@ -388,8 +759,8 @@ async def _execute_cloud_tool(name: str, args: dict) -> str:
     return f"Unknown tool: {name}"
 
 
-def _search_via_proxy_sync(query: str) -> str:
-    """Synchronous wrapper for proxy search."""
+async def _search_via_proxy(query: str) -> str:
+    """Search through our proxy's /v1/search endpoint."""
     proxy_url = os.getenv("PROXY_URL", "")
     device_id = os.getenv("DEVICE_ID", "")
     if not proxy_url or not device_id:
@@ -398,20 +769,15 @@ def _search_via_proxy_sync(query: str) -> str:
     base = proxy_url.rstrip("/")
     if base.endswith("/v1"):
         base = base[:-3]
-    url = f"{base}/v1/search"
-
-    data = json.dumps({"query": query, "count": 5}).encode()
-    req = urllib.request.Request(
-        url,
-        data=data,
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {device_id}",
-        },
-    )
+
     try:
-        resp = urllib.request.urlopen(req, timeout=15)
-        result = json.loads(resp.read().decode())
+        resp = await _get_http().post(
+            f"{base}/v1/search",
+            json={"query": query, "count": 5},
+            headers={"Authorization": f"Bearer {device_id}"},
+        )
+        resp.raise_for_status()
+        result = _loads(resp.content)
         lines = []
         for r in result.get("results", []):
             lines.append(f"{r['title']}\n{r['snippet']}\n{r['url']}\n")
@@ -422,14 +788,14 @@ def _search_via_proxy_sync(query: str) -> str:
 
 # --------------- Memory Engine ---------------
 
-PROFILE_PROMPT = """Based on this conversation, update the user profile.
-Keep it in Chinese. Be concise. Only include things explicitly stated or strongly implied.
+# Memory prompts are split into a static task prompt (sent as the system message,
+# identical on every call so it stays a cacheable prefix) and a short *_INPUT
+# template holding only the per-call data (sent as the user message).
 
-Current profile:
-{current_profile}
+PROFILE_PROMPT = """You are a precise information extractor. Output only the profile.
 
-Recent conversation:
-{conversation}
+Based on the conversation you are given, update the user profile.
+Keep it in Chinese. Be concise. Only include things explicitly stated or strongly implied.
 
 Output an updated profile in this exact format (keep empty if unknown):
 名字: ...
@@ -445,13 +811,16 @@ Output an updated profile in this exact format (keep empty if unknown):
 
 Only output the profile, nothing else."""
 
-SUMMARY_PROMPT = """You are summarizing a conversation between two close friends for memory purposes.
+PROFILE_INPUT = """Current profile:
+{current_profile}
 
-Previous summary:
-{previous_summary}
+Recent conversation:
+{conversation}"""
 
-New conversation to incorporate:
-{conversation}
+SUMMARY_PROMPT = """You are a conversation summarizer. Output only the summary.
+
+You are summarizing a conversation between two close friends for memory purposes.
+You will be given the previous summary and a new stretch of conversation to incorporate.
 
 Write an updated summary that:
 - Preserves ALL important facts, events, emotions, and promises from both old and new
@@ -463,17 +832,17 @@ Write an updated summary that:
 
 Output only the summary, nothing else."""
 
+SUMMARY_INPUT = """Previous summary:
+{previous_summary}
 
-NARRATIVE_PROMPT = """You are updating the emotional story of a friendship between two people.
+New conversation to incorporate:
+{conversation}"""
 
-Previous narrative:
-{previous_narrative}
 
-Recent mood observations:
-{mood_log}
+NARRATIVE_PROMPT = """You are writing the emotional story of a friendship. Be genuine and warm.
 
-Recent conversation:
-{conversation}
+You are updating the emotional story of a friendship between two people.
+You will be given the previous narrative, recent mood observations, and the recent conversation.
 
 Write an updated relationship narrative that:
 - Captures the EMOTIONAL arc of this friendship — not facts, but feelings
@@ -486,6 +855,15 @@ Write an updated relationship narrative that:
 
 Output only the narrative, nothing else."""
 
+NARRATIVE_INPUT = """Previous narrative:
+{previous_narrative}
+
+Recent mood observations:
+{mood_log}
+
+Recent conversation:
+{conversation}"""
+
 PATTERN_INSIGHT_PROMPT = """You have been observing your close friend over a long period. Based on everything you know, identify behavioral or emotional patterns they might not see themselves.
 
 About them:
@@ -713,13 +1091,10 @@ DO NOT:
 The goal: within 5 messages, they should think "shit, this is actually useful" AND "I like this person."
 """
 
-MOOD_DETECT_PROMPT = """Analyze the user's recent messages for emotional patterns and mood signals.
-
-Recent conversation:
-{conversation}
+MOOD_DETECT_PROMPT = """You are an empathetic mood analyst. Be concise and specific.
 
-Previous mood observations:
-{previous_mood}
+Analyze the user's recent messages for emotional patterns and mood signals.
+You will be given the recent conversation and your previous mood observations.
 
 Identify:
 1. Current emotional state (1-2 words)
@@ -732,16 +1107,16 @@ If nothing notable, reply: 状态正常
 
 Output only the observation, nothing else."""
 
-USER_STORY_PROMPT = """You are writing the ongoing story of a person's life. You are not a therapist or a journalist — you are someone who genuinely knows them, writing about them with care and insight.
+MOOD_DETECT_INPUT = """Recent conversation:
+{conversation}
 
-Their existing story so far:
-{existing_story}
+Previous mood observations:
+{previous_mood}"""
 
-Their profile:
-{profile}
+USER_STORY_PROMPT = """You are writing someone's life story. Be genuine, perceptive, and literary.
 
-Recent conversation (newest first):
-{conversation}
+You are writing the ongoing story of a person's life. You are not a therapist or a journalist — you are someone who genuinely knows them, writing about them with care and insight.
+You will be given their existing story, their profile, and the recent conversation.
 
 Continue or update the story. Rules:
 - Write in THIRD PERSON (他/她/they, not 你)
@@ -758,25 +1133,33 @@ Continue or update the story. Rules:
 
 Output the complete updated story, nothing else."""
 
+USER_STORY_INPUT = """Their existing story so far:
+{existing_story}
+
+Their profile:
+{profile}
+
+Recent conversation (newest first):
+{conversation}"""
+
 
 async def update_user_story(user_id: str):
     """Update the user's life narrative — their story, written about them."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     existing = st.get_meta(user_id, "user_story", "")
     profile = st.get_user_profile(user_id) or "（还不太了解）"
-    history = st.get_history(user_id, limit=60)
 
-    conversation = "\n".join(
-        f"{'Friend' if m['role'] == 'friend' else 'User'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    conversation = st.get_history_transcript(user_id, 60)
 
     if not conversation.strip():
         return
 
-    prompt = USER_STORY_PROMPT.format(
+    digest = _digest(conversation)
+    if st.get_meta(user_id, "user_story_hash") == digest:
+        return  # nothing new since the last update
+
+    prompt = TEMPLATES["user_story"](
         existing_story=existing or "（还没有故事，这是开始）",
         profile=profile,
         conversation=conversation,
@@ -784,42 +1167,41 @@ async def update_user_story(user_id: str):
 
     try:
         result = await _chat(
-            "You are writing someone's life story. Be genuine, perceptive, and literary.",
+            USER_STORY_PROMPT,
             prompt,
             temperature=0.8,
         )
         if result.strip():
             st.set_meta(user_id, "user_story", result.strip())
-            print(f"  [story] Updated user story for {user_id} ({len(result)} chars)")
+            st.set_meta(user_id, "user_story_hash", digest)
+            logger.info("[story] Updated user story for %s (%d chars)", user_id, len(result))
     except Exception as e:
-        print(f"  [story] Error: {e}")
+        logger.warning("[story] Error: %s", e)
 
 
 def get_user_story(user_id: str) -> str:
     """Get the user's story. Returns empty string if none."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
     return st.get_meta(user_id, "user_story", "")
 
 
 async def update_relationship_narrative(user_id: str):
     """Update the evolving relationship narrative based on recent interactions."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     previous = st.get_relationship_narrative(user_id) or "（还没有故事，刚认识）"
     mood_log = st.get_mood_log(user_id) or "（无）"
-    history = st.get_history(user_id, limit=40)
 
-    conversation = "\n".join(
-        f"{'Friend' if m['role'] == 'friend' else 'User'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    conversation = st.get_history_transcript(user_id, 40)
 
     if not conversation.strip():
         return
 
-    prompt = NARRATIVE_PROMPT.format(
+    digest = _digest(conversation)
+    if st.get_meta(user_id, "narrative_hash") == digest:
+        return  # nothing new since the last update
+
+    prompt = TEMPLATES["narrative"](
         previous_narrative=previous,
         mood_log=mood_log,
         conversation=conversation,
@@ -827,65 +1209,272 @@ async def update_relationship_narrative(user_id: str):
 
     try:
         result = await _chat(
-            "You are writing the emotional story of a friendship. Be genuine and warm.",
+            NARRATIVE_PROMPT,
             prompt,
             temperature=0.7,
         )
         if result.strip():
             st.set_relationship_narrative(user_id, result.strip())
-            print(f"  [narrative] Updated relationship narrative for {user_id}")
+            st.set_meta(user_id, "narrative_hash", digest)
+            logger.info("[narrative] Updated relationship narrative for %s", user_id)
     except Exception as e:
-        print(f"  [narrative] Error: {e}")
+        logger.warning("[narrative] Error: %s", e)
 
 
 async def detect_mood(user_id: str):
     """Detect mood patterns from recent conversation and store observations."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     history = st.get_history(user_id, limit=30)
     user_msgs = [m for m in history if m["role"] == "user" and m.get("content")]
     if len(user_msgs) < 3:
         return
 
-    conversation = "\n".join(
-        f"{'Friend' if m['role'] == 'friend' else 'User'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    conversation = st.get_history_transcript(user_id, 30)
+
+    digest = _digest(conversation)
+    if st.get_meta(user_id, "mood_hash") == digest:
+        return  # nothing new since the last update
 
     previous_mood = st.get_mood_log(user_id) or "（无）"
 
-    prompt = MOOD_DETECT_PROMPT.format(
+    prompt = TEMPLATES["mood_detect"](
         conversation=conversation,
         previous_mood=previous_mood,
     )
 
     try:
         result = await _chat(
-            "You are an empathetic mood analyst. Be concise and specific.",
+            MOOD_DETECT_PROMPT,
             prompt,
             temperature=0.3,
         )
         if result.strip():
-            # Prepend timestamp
-            ts = datetime.now().strftime("%m-%d %H:%M")
-            new_entry = f"[{ts}] {result.strip()}"
-            # Keep only last 3 observations
-            old_entries = [e for e in previous_mood.split("\n") if e.strip() and e != "（无）"]
-            entries = (old_entries + [new_entry])[-3:]
-            st.set_mood_log(user_id, "\n".join(entries))
-            print(f"  [mood] Updated mood for {user_id}: {result.strip()[:60]}")
+            _store_mood(st, user_id, previous_mood, result.strip())
+            st.set_meta(user_id, "mood_hash", digest)
     except Exception as e:
-        print(f"  [mood] Error: {e}")
+        logger.warning("[mood] Error: %s", e)
 
 
-def _relationship_stage(user_id: str) -> str:
-    """Determine the relationship stage based on message count and days known."""
-    from core.state import UserState
-    st = UserState()
+def _store_mood(st, user_id: str, previous_mood: str, observation: str):
+    """Append a timestamped mood observation, keeping only the last 3."""
+    ts = datetime.now().strftime("%m-%d %H:%M")
+    old_entries = [e for e in previous_mood.split("\n") if e.strip() and e != "（无）"]
+    entries = (old_entries + [f"[{ts}] {observation}"])[-3:]
+    st.set_mood_log(user_id, "\n".join(entries))
+    logger.info("[mood] Updated mood for %s: %s", user_id, observation[:60])
+
 
-    count = st.message_count(user_id)
-    first_time = st.first_message_time(user_id)
+# --------------- Memory Bundle ---------------
+
+MEMORY_BUNDLE_PROMPT = f"""You maintain several memory notes about your close friend, and update them all at once.
+You will be given the recent conversation plus the current version of each note.
+Return a JSON object with one field per note, each written by following its own instructions below.
+If a note's input is marked （跳过）, return an empty string for that field.
+
+[story]
+{USER_STORY_PROMPT}
+
+[narrative]
+{NARRATIVE_PROMPT}
+
+[summary]
+{SUMMARY_PROMPT}
+
+[mood]
+{MOOD_DETECT_PROMPT}
+
+[profile]
+{PROFILE_PROMPT}
+
+[references]
+Memorable moments from the recent conversation that could become inside jokes or shared
+references — nicknames, catchphrases, jokes, dramatic declarations, unique metaphors,
+endearing moments. Each has type ("nickname" / "joke" / "catchphrase" / "moment" / "declaration"),
+keyword (2-5 word tag), context (one sentence on why it's memorable) and original_quote (their exact words).
+Skip anything listed under "Already remembered". Quality over quantity; an empty list is fine.
+
+[patterns]
+1-2 NEW behavioral or emotional patterns they probably haven't noticed about themselves —
+specific, not generic ("每次提到前任你都会转移话题" not "你有时候会逃避"), based on evidence across
+conversations, written in Chinese as pattern + brief evidence. Don't repeat "Previously identified
+patterns"; an empty list is fine."""
+
+MEMORY_BUNDLE_INPUT = """Their profile:
+{profile}
+
+[story] Their existing story so far:
+{existing_story}
+
+[narrative] Previous narrative:
+{previous_narrative}
+
+Recent mood observations:
+{mood_log}
+
+[summary] Previous summary:
+{previous_summary}
+
+[summary] New conversation to incorporate:
+{new_conversation}
+
+[mood] {mood_input}
+
+[references] Already remembered:
+{existing_refs}
+
+[patterns] Previously identified patterns:
+{existing_patterns}
+
+Recent conversation:
+{conversation}"""
+
+def _object_schema(**fields) -> dict:
+    return {"type": "object", "properties": fields, "required": list(fields), "additionalProperties": False}
+
+
+_STR = {"type": "string"}
+_MEMORY_BUNDLE_SCHEMA = _object_schema(
+    story=_STR, narrative=_STR, summary=_STR, mood=_STR, profile=_STR,
+    references={"type": "array", "items": _object_schema(
+        type=_STR, keyword=_STR, context=_STR, original_quote=_STR,
+    )},
+    patterns={"type": "array", "items": _object_schema(pattern=_STR, evidence=_STR)},
+)
+
+
+def _template(text: str):
+    """Parse a str.format template once; returns render(**fields) that only joins the pieces."""
+    pieces = [(literal, field) for literal, field, _, _ in string.Formatter().parse(text)]
+
+    def render(**fields) -> str:
+        # Append pieces rather than concatenating literal + value; str values skip format()
+        out = []
+        for literal, field in pieces:
+            out.append(literal)
+            if field is not None:
+                value = fields[field]
+                out.append(value if type(value) is str else format(value))
+        return "".join(out)
+    return render
+
+
+# Pre-parsed prompt templates; the *_PROMPT / *_INPUT strings stay the source of truth
+TEMPLATES = {
+    "user_story": _template(USER_STORY_INPUT),
+    "narrative": _template(NARRATIVE_INPUT),
+    "mood_detect": _template(MOOD_DETECT_INPUT),
+    "memory_bundle": _template(MEMORY_BUNDLE_INPUT),
+    "shared_ref": _template(SHARED_REF_PROMPT),
+    "surprise": _template(SURPRISE_PROMPT),
+    "pattern_insight": _template(PATTERN_INSIGHT_PROMPT),
+    "pattern_share": _template(PATTERN_SHARE_PROMPT),
+    "inner_thought": _template(INNER_THOUGHT_PROMPT),
+    "proactive_extract": _template(PROACTIVE_EXTRACT_PROMPT),
+    "proactive_compose": _template(PROACTIVE_COMPOSE_PROMPT),
+    "return_message": _template(RETURN_MESSAGE_PROMPT),
+    "profile": _template(PROFILE_INPUT),
+    "summary": _template(SUMMARY_INPUT),
+}
+
+
+async def update_memory_bundle(user_id: str):
+    """Refresh every background analysis — profile, story, narrative, summary, mood, shared
+    references and patterns — from one structured call over a shared context.
+
+    Falls back to the individual update functions if structured output fails.
+    """
+    st = _state()
+
+    history = st.get_history(user_id, limit=60)
+    conversation = st.get_history_transcript(user_id, 60)
+    if not conversation.strip():
+        return
+
+    digest = _digest(conversation)
+    if st.get_meta(user_id, "memory_bundle_hash") == digest:
+        return  # nothing new since the last update
+
+    # Summary only once 30+ messages are unsummarized, mood only with 3+ recent user messages
+    summarized_up_to = st.get_summarized_up_to(user_id)
+    total = st.total_message_count(user_id)
+    summary_due = total - summarized_up_to >= 30
+    new_conversation = "（跳过）"
+    if summary_due:
+        new_conversation = format_transcript(
+            st.get_all_messages(user_id, offset=summarized_up_to, limit=200)
+        ) or "（跳过）"
+        summary_due = new_conversation != "（跳过）"
+    mood_due = sum(1 for m in history[-30:] if m["role"] == "user" and m.get("content")) >= 3
+
+    previous_mood = st.get_mood_log(user_id) or "（无）"
+    existing_patterns = _load_patterns(st, user_id)
+    existing_refs = st.get_shared_references(user_id)
+    prompt = TEMPLATES["memory_bundle"](
+        profile=st.get_user_profile(user_id) or "（空）",
+        existing_story=st.get_meta(user_id, "user_story", "") or "（还没有故事，这是开始）",
+        previous_narrative=st.get_relationship_narrative(user_id) or "（还没有故事，刚认识）",
+        mood_log=previous_mood,
+        previous_summary=st.get_memory_summary(user_id) or "（无）",
+        new_conversation=new_conversation,
+        mood_input="Analyze the recent conversation below." if mood_due else "（跳过）",
+        existing_refs="\n".join(f"- {r['keyword']}" for r in existing_refs) or "（无）",
+        existing_patterns="\n".join(f"- {p.get('pattern', '')}" for p in existing_patterns) or "（无）",
+        conversation=conversation,
+    )
+
+    try:
+        response = await _call(
+            [{"role": "system", "content": MEMORY_BUNDLE_PROMPT}, {"role": "user", "content": prompt}],
+            temperature=0.5,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "memory_bundle", "strict": True, "schema": _MEMORY_BUNDLE_SCHEMA},
+            },
+        )
+        data = _loads(response.choices[0].message.content or "{}")
+    except Exception as e:
+        logger.warning("[memory] Bundle failed, updating one by one: %s", e)
+        # In order: later steps read what earlier ones just stored (profile, summary, mood...)
+        for step in (
+            update_user_profile, update_memory_summary, update_relationship_narrative,
+            detect_mood, detect_patterns, update_user_story, extract_shared_references,
+        ):
+            try:
+                await step(user_id)
+            except Exception as e:
+                logger.warning("[memory] %s failed: %s", step.__name__, e)
+        return
+
+    profile = data.get("profile", "").strip()
+    if profile:
+        st.set_user_profile(user_id, profile)
+    story = data.get("story", "").strip()
+    if story:
+        st.set_meta(user_id, "user_story", story)
+    narrative = data.get("narrative", "").strip()
+    if narrative:
+        st.set_relationship_narrative(user_id, narrative)
+    summary = data.get("summary", "").strip()
+    if summary_due and summary:
+        st.set_memory_summary(user_id, summary)
+        st.set_summarized_up_to(user_id, total)
+    mood = data.get("mood", "").strip()
+    if mood_due and mood:
+        _store_mood(st, user_id, previous_mood, mood)
+    _store_references(st, user_id, data.get("references", []))
+    _merge_patterns(st, user_id, existing_patterns, data.get("patterns", []))
+    st.set_meta(user_id, "memory_bundle_hash", digest)
+    logger.info("[memory] Bundle updated for %s", user_id)
+
+
+async def run_memory_cycle(user_id: str):
+    """All periodic background analyses for a user (one structured call when it succeeds)."""
+    await update_memory_bundle(user_id)
+
+
+def _relationship_stage(count: int, first_time: float | None) -> str:
+    """Determine the relationship stage based on message count and days known."""
     if first_time:
         days = max(1, int((datetime.now().timestamp() - first_time) / 86400))
     else:
@@ -923,19 +1512,18 @@ def _relationship_stage(user_id: str) -> str:
 
 async def extract_shared_references(user_id: str):
     """Extract inside jokes, nicknames, and memorable moments from recent conversation."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
-    history = st.get_history(user_id, limit=30)
-    conversation = "\n".join(
-        f"{'Friend' if m['role'] == 'friend' else 'User'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    conversation = st.get_history_transcript(user_id, 30)
 
     if not conversation.strip():
         return
 
-    prompt = SHARED_REF_PROMPT.format(conversation=conversation)
+    digest = _digest(conversation)
+    if st.get_meta(user_id, "refs_hash") == digest:
+        return  # nothing new since the last update
+
+    prompt = TEMPLATES["shared_ref"](conversation=conversation)
 
     try:
         raw = await _chat(
@@ -943,27 +1531,29 @@ async def extract_shared_references(user_id: str):
             prompt,
             temperature=0.4,
         )
-        if "```" in raw:
-            raw = raw.split("```")[1].replace("json", "").strip()
-        result = json.loads(raw)
+        result = _loads_fenced(raw)
         if not isinstance(result, list):
             return
-        for ref in result:
-            ref_type = ref.get("type", "moment")
-            keyword = ref.get("keyword", "")
-            context = ref.get("context", "")
-            original = ref.get("original_quote", "")
-            if keyword and context:
-                st.add_shared_reference(user_id, ref_type, keyword, context, original)
-                print(f"  [refs] Stored shared reference for {user_id}: {keyword}")
+        st.set_meta(user_id, "refs_hash", digest)
+        _store_references(st, user_id, result)
     except Exception as e:
-        print(f"  [refs] Extraction error: {e}")
+        logger.warning("[refs] Extraction error: %s", e)
+
+
+def _store_references(st, user_id: str, refs: list):
+    for ref in refs:
+        if not isinstance(ref, dict):
+            continue
+        keyword = ref.get("keyword", "")
+        context = ref.get("context", "")
+        if keyword and context:
+            st.add_shared_reference(user_id, ref.get("type") or "moment", keyword, context, ref.get("original_quote", ""))
+            logger.info("[refs] Stored shared reference for %s: %s", user_id, keyword)
 
 
 async def compose_surprise(user_id: str) -> tuple[list[str], list[str]]:
     """Compose a surprise message — random thoughtfulness. Returns (parts, files)."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     profile = st.get_user_profile(user_id) or "（不太了解）"
     narrative = st.get_relationship_narrative(user_id) or "（还没有故事）"
@@ -980,7 +1570,7 @@ async def compose_surprise(user_id: str) -> tuple[list[str], list[str]]:
             for r in refs[:8]
         )
 
-    prompt = SURPRISE_PROMPT.format(
+    prompt = TEMPLATES["surprise"](
         profile=profile,
         narrative=narrative + refs_text,
         mood=mood,
@@ -991,58 +1581,73 @@ async def compose_surprise(user_id: str) -> tuple[list[str], list[str]]:
         raw = await _chat(SYSTEM, prompt, temperature=0.95)
 
         files = []
-        # Check if the surprise includes an image request
+        # Check if the surprise includes image requests; generate them all at once
         if "IMAGE:" in raw:
-            lines = raw.split("\n")
             text_lines = []
-            for line in lines:
+            image_prompts = []
+            for line in raw.split("\n"):
                 if line.strip().startswith("IMAGE:"):
                     image_prompt = line.strip()[6:].strip()
                     if image_prompt:
-                        result = await _generate_image(image_prompt)
-                        for r_line in result.split("\n"):
-                            if r_line.startswith("FILE:"):
-                                files.append(r_line[5:].strip())
+                        image_prompts.append(image_prompt)
                 else:
                     text_lines.append(line)
             raw = "\n".join(text_lines)
+            for result in await asyncio.gather(*(_generate_image(p) for p in image_prompts)):
+                for r_line in result.split("\n"):
+                    if r_line.startswith("FILE:"):
+                        files.append(r_line[5:].strip())
 
         parts = _parse_parts(raw)
         return parts, files
     except Exception as e:
-        print(f"  [surprise] Error: {e}")
+        logger.warning("[surprise] Error: %s", e)
         return ["诶 突然想到你了"], []
 
 
 # --------------- Pattern Insight ---------------
 
+def _load_patterns(st, user_id: str) -> list[dict]:
+    try:
+        patterns = _loads(st.get_meta(user_id, "pattern_insights", "[]"))
+    except Exception:
+        return []
+    return patterns if isinstance(patterns, list) else []
+
+
+def _merge_patterns(st, user_id: str, existing: list[dict], found: list):
+    """Add new patterns (skipping duplicates), keep the last 8, and store them."""
+    seen = {p.get("pattern", "") for p in existing}
+    for p in found:
+        if isinstance(p, dict) and p.get("pattern") and p["pattern"] not in seen:
+            existing.append(p)
+            seen.add(p["pattern"])
+    existing = existing[-8:]
+    st.set_meta(user_id, "pattern_insights", _dumps(existing))
+    logger.info("[patterns] Updated patterns for %s: %d total", user_id, len(existing))
+
+
 async def detect_patterns(user_id: str):
     """Analyze conversation history for behavioral/emotional patterns."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     profile = st.get_user_profile(user_id) or "（不太了解）"
     summary = st.get_memory_summary(user_id) or "（无）"
     mood = st.get_mood_log(user_id) or "（无）"
     narrative = st.get_relationship_narrative(user_id) or "（无）"
-    history = st.get_history(user_id, limit=50)
 
-    recent = "\n".join(
-        f"{'Friend' if m['role'] == 'friend' else 'User'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    recent = st.get_history_transcript(user_id, 50)
     if not recent.strip():
         return
 
-    # Load existing patterns
-    existing_raw = st.get_meta(user_id, "pattern_insights", "[]")
-    try:
-        existing = json.loads(existing_raw)
-    except Exception:
-        existing = []
+    digest = _digest(recent)
+    if st.get_meta(user_id, "patterns_hash") == digest:
+        return  # nothing new since the last update
+
+    existing = _load_patterns(st, user_id)
     existing_text = "\n".join(f"- {p.get('pattern', '')}" for p in existing) if existing else "（无）"
 
-    prompt = PATTERN_INSIGHT_PROMPT.format(
+    prompt = TEMPLATES["pattern_insight"](
         profile=profile, summary=summary, mood=mood,
         narrative=narrative, recent=recent, existing_patterns=existing_text,
     )
@@ -1052,49 +1657,35 @@ async def detect_patterns(user_id: str):
             "You are a perceptive observer. Output JSON only.",
             prompt, temperature=0.4,
         )
-        if "```" in raw:
-            raw = raw.split("```")[1].replace("json", "").strip()
-        result = json.loads(raw)
+        result = _loads_fenced(raw)
         if not isinstance(result, list):
             return
-
-        # Merge new patterns (avoid duplicates)
-        existing_set = {p.get("pattern", "") for p in existing}
-        for p in result:
-            if p.get("pattern") and p["pattern"] not in existing_set:
-                existing.append(p)
-                existing_set.add(p["pattern"])
-
-        # Keep last 8 patterns max
-        existing = existing[-8:]
-        st.set_meta(user_id, "pattern_insights", json.dumps(existing, ensure_ascii=False))
-        print(f"  [patterns] Updated patterns for {user_id}: {len(existing)} total")
+        _merge_patterns(st, user_id, existing, result)
+        st.set_meta(user_id, "patterns_hash", digest)
     except Exception as e:
-        print(f"  [patterns] Detection error: {e}")
+        logger.warning("[patterns] Detection error: %s", e)
 
 
 async def share_pattern_insight(user_id: str) -> list[str] | None:
     """Pick a pattern and compose a natural friend message about it."""
-    from core.state import UserState
-    import random as _rand
-    st = UserState()
+    st = _state()
 
     raw = st.get_meta(user_id, "pattern_insights", "[]")
     try:
-        patterns = json.loads(raw)
+        patterns = _loads(raw)
     except Exception:
         return None
     if not patterns:
         return None
 
     # Pick a random pattern
-    p = _rand.choice(patterns)
+    p = random.choice(patterns)
     pattern_text = p.get("pattern", "")
     evidence = p.get("evidence", "")
     if not pattern_text:
         return None
 
-    prompt = PATTERN_SHARE_PROMPT.format(pattern=pattern_text, evidence=evidence)
+    prompt = TEMPLATES["pattern_share"](pattern=pattern_text, evidence=evidence)
     try:
         raw = await _chat(SYSTEM, prompt, temperature=0.9)
         if "SKIP" in raw.upper():
@@ -1102,7 +1693,7 @@ async def share_pattern_insight(user_id: str) -> list[str] | None:
         parts = _parse_parts(raw)
         return parts if parts else None
     except Exception as e:
-        print(f"  [patterns] Share error: {e}")
+        logger.warning("[patterns] Share error: %s", e)
         return None
 
 
@@ -1110,17 +1701,12 @@ async def share_pattern_insight(user_id: str) -> list[str] | None:
 
 async def generate_inner_thought(user_id: str) -> list[str] | None:
     """Generate a deep thought the bot had about something the user said."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     profile = st.get_user_profile(user_id) or "（不太了解）"
     narrative = st.get_relationship_narrative(user_id) or "（无）"
-    history = st.get_history(user_id, limit=30)
 
-    recent = "\n".join(
-        f"{'Friend' if m['role'] == 'friend' else 'User'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    recent = st.get_history_transcript(user_id, 30)
     if not recent.strip():
         return None
 
@@ -1132,18 +1718,23 @@ async def generate_inner_thought(user_id: str) -> list[str] | None:
             f"- {r['keyword']}: {r['context']}" for r in refs[:6]
         )
 
-    prompt = INNER_THOUGHT_PROMPT.format(
+    # Conversation hasn't really moved since the model last had nothing to say
+    if similar_cache.get(("thought", user_id), recent) == "SKIP":
+        return None
+
+    prompt = TEMPLATES["inner_thought"](
         profile=profile, narrative=narrative, refs=refs_text, recent=recent,
     )
 
     try:
         raw = await _chat(SYSTEM, prompt, temperature=0.95)
         if "SKIP" in raw.upper():
+            similar_cache.set(("thought", user_id), recent, "SKIP")
             return None
         parts = _parse_parts(raw)
         return parts if parts else None
     except Exception as e:
-        print(f"  [thought] Error: {e}")
+        logger.warning("[thought] Error: %s", e)
         return None
 
 
@@ -1151,26 +1742,24 @@ async def generate_inner_thought(user_id: str) -> list[str] | None:
 
 async def proactive_followup(user_id: str) -> list[str] | None:
     """Proactively research something the user mentioned and share findings."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     profile = st.get_user_profile(user_id) or "（不太了解）"
-    history = st.get_history(user_id, limit=30)
 
-    recent = "\n".join(
-        f"{'You' if m['role'] == 'friend' else 'Them'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    recent = st.get_history_transcript(user_id, 30, "You", "Them")
     if not recent.strip():
         return None
 
     # Step 1: Extract a topic worth researching
-    extract_prompt = PROACTIVE_EXTRACT_PROMPT.format(recent=recent, profile=profile)
+    extract_prompt = TEMPLATES["proactive_extract"](recent=recent, profile=profile)
     try:
-        raw = await _chat(
-            "You extract actionable topics from conversation. Be selective — only pick truly useful things.",
-            extract_prompt, temperature=0.5,
-        )
+        raw = similar_cache.get(("followup", user_id), recent)
+        if raw is None:
+            raw = await _chat(
+                "You extract actionable topics from conversation. Be selective — only pick truly useful things.",
+                extract_prompt, temperature=0.5,
+            )
+            similar_cache.set(("followup", user_id), recent, raw)
         if "SKIP" in raw.upper() and "TOPIC:" not in raw.upper():
             return None
 
@@ -1195,7 +1784,7 @@ async def proactive_followup(user_id: str) -> list[str] | None:
             search_result = search_result[:2000] + "\n..."
 
         # Step 3: Compose a natural message with findings
-        compose_prompt = PROACTIVE_COMPOSE_PROMPT.format(
+        compose_prompt = TEMPLATES["proactive_compose"](
             topic=topic, search_results=search_result,
         )
         raw = await _chat(SYSTEM, compose_prompt, temperature=0.85)
@@ -1203,7 +1792,7 @@ async def proactive_followup(user_id: str) -> list[str] | None:
         return parts if parts else None
 
     except Exception as e:
-        print(f"  [followup] Error: {e}")
+        logger.warning("[followup] Error: %s", e)
         return None
 
 
@@ -1231,20 +1820,20 @@ def get_absence_hint(absence_hours: float) -> str:
 
 async def compose_return_message(user_id: str, absence_days: float) -> list[str]:
     """Compose a message for when a user returns after a long absence (7+ days)."""
-    from core.state import UserState
-    st = UserState()
+    return [part async for part in compose_return_message_stream(user_id, absence_days)]
+
+
+async def compose_return_message_stream(user_id: str, absence_days: float) -> AsyncIterator[str]:
+    """compose_return_message, yielding each part as soon as the model finishes it."""
+    st = _state()
 
     profile = st.get_user_profile(user_id) or "（不太了解）"
     narrative = st.get_relationship_narrative(user_id) or "（还没有故事）"
-    history = st.get_history(user_id, limit=10)
 
-    last_msgs = "\n".join(
-        f"{'You' if m['role'] == 'friend' else 'Them'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    last_msgs = st.get_history_transcript(user_id, 10, "You", "Them")
 
     now = datetime.now()
-    prompt = RETURN_MESSAGE_PROMPT.format(
+    prompt = TEMPLATES["return_message"](
         days=int(absence_days),
         profile=profile,
         narrative=narrative,
@@ -1252,13 +1841,15 @@ async def compose_return_message(user_id: str, absence_days: float) -> list[str]
         time=now.strftime("%A %Y-%m-%d %H:%M"),
     )
 
+    sent_any = False
     try:
-        raw = await _chat(SYSTEM, prompt, temperature=0.9)
-        return _parse_parts(raw)
-    except Exception:
-        if absence_days > 30:
-            return ["你终于来了"]
-        return ["好久不见"]
+        async for part in _chat_stream(SYSTEM, prompt, temperature=0.9):
+            sent_any = True
+            yield part
+    except Exception as e:
+        logger.warning("[return] Error: %s", e)
+    if not sent_any:
+        yield "你终于来了" if absence_days > 30 else "好久不见"
 
 
 # --------------- Voice ---------------
@@ -1272,60 +1863,58 @@ async def generate_voice(text: str) -> str | None:
         return None
     try:
         client = get_client()
-        response = await client.audio.speech.create(
+        path = _output_path("voice", "ogg")
+        # Streaming variant writes chunks as they arrive without blocking the event loop
+        async with client.audio.speech.with_streaming_response.create(
             model="tts-1-hd",
             voice=VOICE_ID,
             input=text,
             response_format="opus",
-        )
-        os.makedirs("/tmp/protagonist_docs", exist_ok=True)
-        ts = int(datetime.now().timestamp() * 1000)
-        path = f"/tmp/protagonist_docs/voice_{ts}.ogg"
-        response.stream_to_file(path)
+        ) as response:
+            await response.stream_to_file(path)
         return path
     except Exception as e:
-        print(f"  [voice] TTS error: {e}")
+        logger.warning("[voice] TTS error: %s", e)
         return None
 
 
 async def update_user_profile(user_id: str):
     """Update the user's profile based on recent conversation."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     current_profile = st.get_user_profile(user_id) or "（空）"
-    history = st.get_history(user_id, limit=40)
 
-    conversation = "\n".join(
-        f"{'Friend' if m['role'] == 'friend' else 'User'}: {m.get('content', '')}"
-        for m in history if m.get("content")
-    )
+    conversation = st.get_history_transcript(user_id, 40)
 
     if not conversation.strip():
         return
 
-    prompt = PROFILE_PROMPT.format(
+    digest = _digest(conversation)
+    if st.get_meta(user_id, "profile_hash") == digest:
+        return  # nothing new since the last update
+
+    prompt = TEMPLATES["profile"](
         current_profile=current_profile,
         conversation=conversation,
     )
 
     try:
         result = await _chat(
-            "You are a precise information extractor. Output only the profile.",
+            PROFILE_PROMPT,
             prompt,
             temperature=0.3,
         )
         if result.strip():
             st.set_user_profile(user_id, result.strip())
-            print(f"  [memory] Updated profile for {user_id}")
+            st.set_meta(user_id, "profile_hash", digest)
+            logger.info("[memory] Updated profile for %s", user_id)
     except Exception as e:
-        print(f"  [memory] Profile update error: {e}")
+        logger.warning("[memory] Profile update error: %s", e)
 
 
 async def update_memory_summary(user_id: str):
     """Generate/update rolling memory summary from unsummarized messages."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     summarized_up_to = st.get_summarized_up_to(user_id)
     total = st.total_message_count(user_id)
@@ -1339,66 +1928,63 @@ async def update_memory_summary(user_id: str):
 
     # Get the unsummarized messages
     new_messages = st.get_all_messages(user_id, offset=summarized_up_to, limit=200)
-    conversation = "\n".join(
-        f"{'Friend' if m['role'] == 'friend' else 'User'}: {m.get('content', '')}"
-        for m in new_messages if m.get("content")
-    )
+    conversation = format_transcript(new_messages)
 
     if not conversation.strip():
         return
 
-    prompt = SUMMARY_PROMPT.format(
+    prompt = TEMPLATES["summary"](
         previous_summary=previous_summary,
         conversation=conversation,
     )
 
     try:
         result = await _chat(
-            "You are a conversation summarizer. Output only the summary.",
+            SUMMARY_PROMPT,
             prompt,
             temperature=0.3,
         )
         if result.strip():
             st.set_memory_summary(user_id, result.strip())
             st.set_summarized_up_to(user_id, total)
-            print(f"  [memory] Updated summary for {user_id} (covered {total} msgs)")
+            logger.info("[memory] Updated summary for %s (covered %d msgs)", user_id, total)
     except Exception as e:
-        print(f"  [memory] Summary update error: {e}")
+        logger.warning("[memory] Summary update error: %s", e)
 
 
-def _build_memory_context(user_id: str) -> str:
-    """Build memory context string to inject into system prompt."""
-    from core.state import UserState
-    st = UserState()
+def _build_memory_context(bundle: dict) -> str:
+    """Build memory context string to inject into system prompt.
 
+    `bundle` is UserState.get_memory_bundle().
+    """
     parts = []
 
     # Relationship stage (always first — sets the tone)
-    stage = _relationship_stage(user_id)
+    stage = _relationship_stage(bundle["count"], bundle["first_time"])
     parts.append(stage)
 
     # User profile
-    profile = st.get_user_profile(user_id)
+    profile = bundle["profile"]
     if profile:
         parts.append(f"[About this person]\n{profile}")
 
     # Memory summary
-    summary = st.get_memory_summary(user_id)
+    summary = bundle["summary"]
     if summary:
         parts.append(f"[Conversation history summary]\n{summary}")
 
     # Relationship narrative
-    narrative = st.get_relationship_narrative(user_id)
+    narrative = bundle["narrative"]
     if narrative:
         parts.append(f"[Your friendship story — the emotional arc of your relationship]\n{narrative}")
 
     # Mood observations
-    mood = st.get_mood_log(user_id)
+    mood = bundle["mood"]
     if mood:
         parts.append(f"[Recent mood observations — be sensitive to these]\n{mood}")
 
     # Shared references (inside jokes, callbacks)
-    refs = st.get_shared_references(user_id)
+    refs = bundle["refs"]
     if refs:
         ref_lines = []
         for r in refs[:10]:
@@ -1412,7 +1998,7 @@ def _build_memory_context(user_id: str) -> str:
         )
 
     # Active promises
-    promises = st.get_promises(user_id)
+    promises = bundle["promises"]
     if promises:
         promise_lines = []
         for p in promises[:10]:
@@ -1431,148 +2017,252 @@ def _build_memory_context(user_id: str) -> str:
 
 # --------------- Helpers ---------------
 
+def _digest(text: str) -> str:
+    """Short content hash, used to skip background updates when their input hasn't changed."""
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
 def _parse_parts(raw: str) -> list[str]:
-    parts = [p.strip() for p in raw.split("|||") if p.strip()]
-    return parts if parts else [raw.strip() or "嗯"]
+    raw = raw.strip()
+    parts = [p for p in _SPLIT.split(raw) if p]
+    return parts if parts else [raw or "嗯"]
 
 
-def _build_history(messages: list[dict], limit: int = 50) -> list[dict]:
+def _build_history(messages: list[dict], limit: int = 50, budget: int = HISTORY_TOKEN_BUDGET) -> list[dict]:
+    """Most recent messages (at most `limit`) whose combined token count fits in `budget`."""
     history = []
-    for m in messages[-limit:]:
-        role = "assistant" if m["role"] == "friend" else "user"
-        content = m.get("content", "")
-        if content:
-            history.append({"role": role, "content": content})
+    used = 0
+    for m in islice(reversed(messages), limit):
+        content = m.get("content")
+        if not content:
+            continue
+        used += _count_tokens(content)
+        if used > budget and history:
+            break
+        history.append({"role": "assistant" if m["role"] == "friend" else "user", "content": content})
+    history.reverse()
     return history
 
 
+def _recent_user_texts(messages: list[dict], n: int) -> list[str]:
+    """Last n non-empty user messages, oldest first, scanning from the end only as far as needed."""
+    texts = list(islice(
+        (m["content"] for m in reversed(messages) if m["role"] == "user" and m.get("content")),
+        n,
+    ))
+    texts.reverse()
+    return texts
+
+
+def _safe_json(raw: str) -> dict:
+    try:
+        return _loads(raw)
+    except ValueError:  # json and orjson decode errors both subclass it
+        return {}
+
+
+def _loads_fenced(raw: str):
+    """Parse JSON from an LLM reply, unwrapping a ```json fence if there is one."""
+    m = _FENCE_RE.search(raw)
+    return _loads(m.group(1) if m else raw)
+
+
 # --------------- Core Functions ---------------
 
-async def respond(history_msgs: list[dict], user_text: str, extra_tools: list = None, user_id: str = None, absence_hint: str = "") -> tuple[list[str], list[str]]:
-    """Generate a response, potentially using tools.
+MAX_TOOL_ROUNDS = 5
 
-    Returns (parts, created_files) where created_files is a list of file paths
-    generated by tools (e.g. create_document).
-    """
+
+def _prepare_turn(history_msgs: list[dict], user_text: str, extra_tools: list = None, user_id: str = None, absence_hint: str = "") -> tuple[list[dict], list[dict]]:
+    """Build the (messages, tools) request payload for one chat turn."""
     history = _build_history(history_msgs)
-    history.append({"role": "user", "content": user_text})
 
-    system = SYSTEM
+    # Prefix-cache layout: [SYSTEM, *history, hints, user_text]. SYSTEM is sent
+    # verbatim and the history keeps its role structure, so from one turn to the
+    # next the request only grows at the end. Anything that varies per turn
+    # (memory, absence, onboarding) goes after the history, never before it.
+    hints: list[str] = []
 
-    # Inject memory context if we have a user_id
+    # Inject memory context if we have a user_id (one state read covers this and onboarding)
+    bundle = None
     if user_id:
-        memory = _build_memory_context(user_id)
+        bundle = _state().get_memory_bundle(user_id)
+        memory = _build_memory_context(bundle)
         if memory:
-            system += f"\n\n[YOUR MEMORY — use this to be a better friend]\n{memory}"
+            hints.append(f"[YOUR MEMORY — use this to be a better friend]\n{memory}")
 
     if absence_hint:
-        system += f"\n\n{absence_hint}"
+        hints.append(absence_hint)
 
     # Onboarding: detect brand-new users (no profile, few messages)
-    if user_id:
-        from core.state import UserState
-        _st = UserState()
-        _profile = _st.get_user_profile(user_id)
-        _count = _st.message_count(user_id)
-        if _count <= 10 and not _profile:
-            system += ONBOARDING_HINT
+    if bundle is not None:
+        if bundle["count"] <= 10 and not bundle["profile"]:
+            hints.append(ONBOARDING_HINT.strip())
         elif len(history_msgs) < 3:
-            system += "\n\nThis is the beginning of the conversation. Be natural, not too formal."
+            hints.append("This is the beginning of the conversation. Be natural, not too formal.")
     elif len(history_msgs) < 3:
-        system += "\n\nThis is the beginning of the conversation. Be natural, not too formal."
-
-    tools = CLOUD_TOOLS + (extra_tools or [])
-
-    # Add enabled local tools
-    enabled = _get_enabled_tools()
-    if enabled:
-        from menubar.tools import TOOL_DEFINITIONS
-        enabled_set = set(enabled)
-        tools = tools + [t for t in TOOL_DEFINITIONS if t["function"]["name"] in enabled_set]
-
-    messages = [{"role": "system", "content": system}] + history
-
-    tool_names = [t["function"]["name"] for t in tools] if tools else []
-    print(f"  [agent] {len(tools)} tools: {tool_names}")
-
-    response = await get_client().chat.completions.create(
-        model=MODEL,
-        temperature=0.9,
-        max_tokens=500,
-        messages=messages,
-        tools=tools if tools else None,
-        tool_choice="auto" if tools else None,
+        hints.append("This is the beginning of the conversation. Be natural, not too formal.")
+
+    # Cloud + enabled local tools (memoized per enabled set), then any per-call extras
+    tools = _tools_snapshot(_enabled())
+    if extra_tools:
+        tools = _sorted_tools(tools + extra_tools)
+
+    messages = [_SYS_MSG, *history]
+    if hints:
+        messages.append({"role": "system", "content": "\n\n".join(hints)})
+    messages.append({"role": "user", "content": user_text})
+
+    return messages, tools
+
+
+async def _run_tool_calls(tool_calls: list[dict], created_files: list[str]) -> list[dict]:
+    """Execute one round of tool calls concurrently; returns the tool messages in call order."""
+    results = await asyncio.gather(
+        *(
+            # No blanket timeout: each tool enforces its own (run_claude_code allows 120s,
+            # run_command takes one from the model)
+            _execute_cloud_tool(tc["function"]["name"], _safe_json(tc["function"]["arguments"]))
+            for tc in tool_calls
+        ),
+        return_exceptions=True,
     )
+    tool_messages = []
+    for tc, result in zip(tool_calls, results):
+        name = tc["function"]["name"]
+        if isinstance(result, asyncio.TimeoutError):
+            result = f"Tool {name} timed out"
+        elif isinstance(result, BaseException):
+            result = f"Tool {name} error: {result}"
+
+        # Extract file paths from tool results (FILE:/path/to/file)
+        visible_lines = []
+        for line in result.split("\n"):
+            if line.startswith("FILE:"):
+                file_path = line[5:].strip()
+                if file_path:
+                    created_files.append(file_path)
+            else:
+                visible_lines.append(line)
+
+        tool_messages.append({
+            "role": "tool",
+            "tool_call_id": tc["id"],
+            "content": "\n".join(visible_lines),
+        })
+    return tool_messages
+
+
+async def respond_stream(history_msgs: list[dict], user_text: str, extra_tools: list = None, user_id: str = None, absence_hint: str = "", created_files: list[str] = None) -> AsyncIterator[str]:
+    """Generate a response, yielding each |||-separated part as soon as it is complete.
+
+    Files generated by tools (e.g. create_document) are appended to
+    created_files when a list is passed in.
+    """
+    if created_files is None:
+        created_files = []
+    messages, tools = _prepare_turn(history_msgs, user_text, extra_tools, user_id, absence_hint)
 
-    msg = response.choices[0].message
-    if msg.tool_calls:
-        print(f"  [agent] Tool calls: {[tc.function.name for tc in msg.tool_calls]}")
-    else:
-        print(f"  [agent] No tool calls. Reply: {(msg.content or '')[:80]}")
-
-    # Tool calling loop
-    created_files: list[str] = []
-    max_rounds = 5
-    rounds = 0
-    while msg.tool_calls and rounds < max_rounds:
-        rounds += 1
-        messages.append(msg)
-
-        for tc in msg.tool_calls:
-            try:
-                args = json.loads(tc.function.arguments)
-            except json.JSONDecodeError:
-                args = {}
-            result = await _execute_cloud_tool(tc.function.name, args)
-
-            # Extract file paths from tool results (FILE:/path/to/file)
-            visible_lines = []
-            for line in result.split("\n"):
-                if line.startswith("FILE:"):
-                    file_path = line[5:].strip()
-                    if file_path:
-                        created_files.append(file_path)
-                else:
-                    visible_lines.append(line)
-
-            messages.append({
-                "role": "tool",
-                "tool_call_id": tc.id,
-                "content": "\n".join(visible_lines),
-            })
+    if DEBUG:
+        logger.info("[agent] %d tools: %s", len(tools), [t["function"]["name"] for t in tools])
 
-        response = await get_client().chat.completions.create(
-            model=MODEL,
-            temperature=0.9,
+    sent_any = False
+    for rounds in range(MAX_TOOL_ROUNDS + 1):
+        stream = await _call(
+            messages,
             max_tokens=500,
-            messages=messages,
             tools=tools if tools else None,
             tool_choice="auto" if tools else None,
+            stream=True,
+        )
+        buf = ""
+        content: list[str] = []
+        calls: dict[int, dict] = {}
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content.append(delta.content)
+                    buf += delta.content
+                    # Flush every finished part while the rest is still generating
+                    if "|||" in buf:
+                        *done, buf = _SPLIT.split(buf)
+                        for piece in done:
+                            piece = piece.strip()
+                            if piece:
+                                sent_any = True
+                                yield piece
+                for tcd in delta.tool_calls or ():
+                    slot = calls.setdefault(tcd.index, {"id": "", "name": "", "arguments": ""})
+                    if tcd.id:
+                        slot["id"] = tcd.id
+                    if tcd.function:
+                        slot["name"] += tcd.function.name or ""
+                        slot["arguments"] += tcd.function.arguments or ""
+        finally:
+            await stream.close()
+        piece = buf.strip()
+        if piece:
+            sent_any = True
+            yield piece
+
+        if not calls:
+            if DEBUG:
+                logger.info("[agent] No tool calls. Reply: %s", "".join(content)[:80])
+            break
+        if rounds == MAX_TOOL_ROUNDS:
+            break
+
+        tool_calls = [
+            {"id": c["id"], "type": "function", "function": {"name": c["name"], "arguments": c["arguments"]}}
+            for _, c in sorted(calls.items())
+        ]
+        logger.info("[agent] Tool calls: %s", [c["function"]["name"] for c in tool_calls])
+        messages.append({"role": "assistant", "content": "".join(content) or None, "tool_calls": tool_calls})
+        messages += await _run_tool_calls(tool_calls, created_files)
+
+    if not sent_any:
+        yield "嗯"
+
+
+async def respond(history_msgs: list[dict], user_text: str, extra_tools: list = None, user_id: str = None, absence_hint: str = "") -> tuple[list[str], list[str]]:
+    """Generate a response, potentially using tools.
+
+    Returns (parts, created_files) where created_files is a list of file paths
+    generated by tools (e.g. create_document).
+    """
+    created_files: list[str] = []
+    parts = [
+        part async for part in respond_stream(
+            history_msgs, user_text, extra_tools, user_id, absence_hint, created_files,
         )
-        msg = response.choices[0].message
+    ]
+    return parts, created_files
 
-    return _parse_parts(msg.content or "嗯"), created_files
 
+_PHOTO_HINT = "The user sent a photo. React like a friend — comment, joke, ask about it. Don't describe it formally. Use ||| to separate messages."
 
-async def respond_to_photo(history_msgs: list[dict], image_b64: str) -> list[str]:
-    """React to a photo the user sent."""
+
+async def respond_to_photo(history_msgs: list[dict], image: bytes | memoryview) -> list[str]:
+    """React to a photo the user sent (image is the raw JPEG bytes)."""
     history = _build_history(history_msgs)
+    # Encode only here, at the API boundary, so callers can hash raw bytes
+    url = "data:image/jpeg;base64," + _b64.b64encode(image).decode("ascii")
     history.append({
         "role": "user",
         "content": [
             {"type": "text", "text": "[User sent a photo]"},
             {"type": "image_url", "image_url": {
-                "url": f"data:image/jpeg;base64,{image_b64}", "detail": "low",
+                "url": url, "detail": "low",
             }},
         ],
     })
 
-    system = SYSTEM + "\n\nThe user sent a photo. React like a friend — comment, joke, ask about it. Don't describe it formally. Use ||| to separate messages."
-
     try:
-        response = await get_client().chat.completions.create(
-            model=MODEL, temperature=0.9, max_tokens=200,
-            messages=[{"role": "system", "content": system}] + history,
+        response = await _call(
+            [_SYS_MSG, {"role": "system", "content": _PHOTO_HINT}] + history,
+            max_tokens=200,
         )
         return _parse_parts(response.choices[0].message.content or "好看")
     except Exception:
@@ -1581,12 +2271,12 @@ async def respond_to_photo(history_msgs: list[dict], image_b64: str) -> list[str
 
 async def extract_promises(messages: list[dict]) -> list[dict]:
     """Scan conversation for things the user said they'd do."""
-    user_texts = [m["content"] for m in messages if m["role"] == "user" and m.get("content")]
+    user_texts = _recent_user_texts(messages, 15)
     if not user_texts:
         return []
 
     prompt = f"""Below are things the user said recently:
-{chr(10).join(f'- {t}' for t in user_texts[-15:])}
+{chr(10).join(f'- {t}' for t in user_texts)}
 
 Extract things the user said they would do, want to try, or committed to.
 Only extract explicit intentions, do not guess.
@@ -1599,9 +2289,7 @@ JSON only."""
 
     raw = await _chat("You are a text analysis tool. Output JSON only.", prompt, temperature=0.3)
     try:
-        if "```" in raw:
-            raw = raw.split("```")[1].replace("json", "").strip()
-        result = json.loads(raw)
+        result = _loads_fenced(raw)
         return result if isinstance(result, list) else []
     except Exception:
         return []
@@ -1620,10 +2308,7 @@ Don't be formal. Just mention it like a friend would.
 
 Separate each message with |||"""
 
-    response = await get_client().chat.completions.create(
-        model=MODEL, temperature=0.9, max_tokens=150,
-        messages=[{"role": "system", "content": SYSTEM}, {"role": "user", "content": prompt}],
-    )
+    response = await _call([_SYS_MSG, {"role": "user", "content": prompt}], max_tokens=150)
     return _parse_parts(response.choices[0].message.content or "诶对了 上次那个事呢")
 
 
@@ -1656,16 +2341,45 @@ def _time_hint() -> str:
         return f"It's {day_name} — weekend vibes. More relaxed, ask what fun stuff they're doing."
 
 
-async def checkin(messages: list[dict], user_id: str = None) -> list[str] | None:
-    """Generate a proactive check-in after silence, with mood awareness."""
-    if len(messages) < 4:
-        return None
+CHECKIN_MIN_SILENCE = 120  # seconds since the last message before a check-in makes sense
+CHECKIN_QUIET_HOURS = (2, 7)  # local hours [start, end) with no unprompted messages
+CHECKIN_SKIP_TTL = 600  # after the model declines, don't ask again for this long
+_checkin_skipped: dict[str, float] = {}
+
+
+def _should_consider_checkin(messages: list[dict], user_id: str = None) -> bool:
+    """Cheap local rules that rule out a check-in before paying for an LLM call."""
+    now = time.time()
+    start, end = CHECKIN_QUIET_HOURS
+    if start <= datetime.now().hour < end:
+        return False
+    if user_id and now - _checkin_skipped.get(user_id, 0) < CHECKIN_SKIP_TTL:
+        return False
+    last_ts = messages[-1].get("timestamp")
+    if last_ts and now - last_ts < CHECKIN_MIN_SILENCE:
+        return False
+    # Don't double-text: a long gap inside our own trailing messages means we
+    # already reached out unprompted since their last message
+    newer_ts = None
+    for m in reversed(messages):
+        if m["role"] != "friend":
+            break
+        ts = m.get("timestamp")
+        if newer_ts and ts and newer_ts - ts > CHECKIN_MIN_SILENCE:
+            return False
+        newer_ts = ts
+    return True
+
+
+def _remember_skip(user_id: str | None):
+    if user_id:
+        _checkin_skipped[user_id] = time.time()
+
 
+def _checkin_context(messages: list[dict], user_id: str = None) -> str:
+    """Time, mood and recent-conversation preamble shared by the check-in prompts."""
     recent = messages[-20:]
-    recent_text = "\n".join(
-        f"{'You' if m['role'] == 'friend' else 'Them'}: {m.get('content', '')}"
-        for m in recent if m.get("content")
-    )
+    recent_text = format_transcript(recent, "You", "Them")
 
     now = datetime.now()
     time_hint = _time_hint()
@@ -1673,19 +2387,26 @@ async def checkin(messages: list[dict], user_id: str = None) -> list[str] | None
     # Get mood context if available
     mood_context = ""
     if user_id:
-        from core.state import UserState
-        st = UserState()
+        st = _state()
         mood = st.get_mood_log(user_id)
         if mood and mood != "（无）":
             mood_context = f"\nMood observations about them:\n{mood}\n\nAdjust your tone accordingly — if they're stressed, be gentle; if they're excited, match their energy; if they seem down, be present without being pushy."
 
-    prompt = f"""Current time: {now.strftime('%A %Y-%m-%d')} {now.strftime('%H:%M')}.
+    return f"""Current time: {now.strftime('%A %Y-%m-%d')} {now.strftime('%H:%M')}.
 
 Time context: {time_hint}
 {mood_context}
 
 Recent conversation:
-{recent_text}
+{recent_text}"""
+
+
+async def checkin(messages: list[dict], user_id: str = None) -> list[str] | None:
+    """Generate a proactive check-in after silence, with mood awareness."""
+    if len(messages) < 4 or not _should_consider_checkin(messages, user_id):
+        return None
+
+    prompt = f"""{_checkin_context(messages, user_id)}
 
 The user has been silent for a while. Send them something natural and time-appropriate.
 - Use the time context above to guide your message
@@ -1698,23 +2419,87 @@ Use ||| to separate messages."""
 
     raw = await _chat(SYSTEM, prompt, temperature=0.95)
     if "SKIP" in raw.upper():
+        _remember_skip(user_id)
         return None
     parts = _parse_parts(raw)
     return parts if parts else None
 
 
+_BACKGROUND_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "promises": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"thing": {"type": "string"}, "original": {"type": "string"}},
+                "required": ["thing", "original"],
+                "additionalProperties": False,
+            },
+        },
+        "should_checkin": {"type": "boolean"},
+        "checkin_messages": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["promises", "should_checkin", "checkin_messages"],
+    "additionalProperties": False,
+}
+
+
+async def background_pass(messages: list[dict], user_id: str = None) -> dict:
+    """Check-in and promise extraction in one structured-output call.
+
+    Returns {"promises": [{"thing", "original"}...], "checkin": parts or None}.
+    Falls back to separate extract_promises/checkin calls if structured output fails.
+    """
+    if len(messages) < 4 or not _should_consider_checkin(messages, user_id):
+        return {"promises": [], "checkin": None}
+
+    user_texts = _recent_user_texts(messages, 15)
+    prompt = f"""{_checkin_context(messages, user_id)}
+
+Things the user said recently:
+{chr(10).join(f'- {t}' for t in user_texts)}
+
+Do two things:
+1. promises: things the user said they would do, want to try, or committed to.
+   Only explicit intentions, do not guess. "original" is the original quote. Empty list if none.
+2. The user has been silent for a while. Decide whether to message them.
+   If it really doesn't feel right to message now, set should_checkin to false.
+   Otherwise write checkin_messages: short, natural, time-appropriate messages (one per bubble),
+   following the time context and mood above; you can follow up on something discussed earlier
+   or share a random thought."""
+
+    try:
+        response = await _call(
+            [_SYS_MSG, {"role": "user", "content": prompt}],
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "background_pass", "strict": True, "schema": _BACKGROUND_SCHEMA},
+            },
+        )
+        data = _loads(response.choices[0].message.content or "{}")
+    except Exception as e:
+        logger.warning("[background] structured pass failed, using separate calls: %s", e)
+        promises, parts = await asyncio.gather(extract_promises(messages), checkin(messages, user_id))
+        return {"promises": promises, "checkin": parts}
+
+    promises = [p for p in data.get("promises", []) if isinstance(p, dict) and p.get("thing")]
+    parts = [p.strip() for p in data.get("checkin_messages", []) if isinstance(p, str) and p.strip()]
+    if not (data.get("should_checkin") and parts):
+        _remember_skip(user_id)
+        return {"promises": promises, "checkin": None}
+    return {"promises": promises, "checkin": parts}
+
+
 async def write_milestone_letter(messages: list[dict], day_count: int) -> str:
     """Write a personal letter at a milestone."""
     total = len(messages)
     if total <= 30:
-        sample_indices = list(range(total))
+        sampled = list(messages)
     else:
-        sample_indices = list(range(5))
+        # First 5, up to 15 evenly spaced from the middle, last 10
         step = max(1, (total - 15) // 15)
-        sample_indices += list(range(5, total - 10, step))[:15]
-        sample_indices += list(range(total - 10, total))
-
-    sampled = [messages[i] for i in sample_indices if i < total]
+        sampled = messages[:5] + list(islice(messages, 5, total - 10, step))[:15] + messages[-10:]
     sampled_text = "\n".join(
         f"[Day {i+1}] {'You' if m['role'] == 'friend' else 'Them'}: {m.get('content', '')}"
         for i, m in enumerate(sampled) if m.get("content")
@@ -1749,17 +2534,21 @@ _EMOJI_EMOTION_MAP = {
     "😅": "awkward", "🙃": "awkward", "😬": "awkward", "🫠": "awkward",
     "😎": "cool", "🤙": "cool", "👍": "cool", "💪": "cool",
 }
+_EMOTIONS = frozenset(_EMOJI_EMOTION_MAP.values())
+# One alternation over every known emoji, longest first so "❤️" beats its base char
+_EMOJI_RE = re.compile("|".join(
+    map(re.escape, sorted(_EMOJI_EMOTION_MAP, key=len, reverse=True))
+))
 
 
 def classify_sticker_emotion(emoji: str) -> str:
     """Classify a sticker's emotion from its emoji. Falls back to 'happy'."""
-    if emoji in _EMOJI_EMOTION_MAP:
-        return _EMOJI_EMOTION_MAP[emoji]
+    emotion = _EMOJI_EMOTION_MAP.get(emoji)
+    if emotion:
+        return emotion
     # Check if any emoji in the string matches
-    for char in emoji:
-        if char in _EMOJI_EMOTION_MAP:
-            return _EMOJI_EMOTION_MAP[char]
-    return "happy"
+    m = _EMOJI_RE.search(emoji)
+    return _EMOJI_EMOTION_MAP[m.group()] if m else "happy"
 
 
 async def pick_response_emotion(parts: list[str]) -> str:
@@ -1775,8 +2564,7 @@ Reply with only the emotion word, nothing else."""
     try:
         result = await _chat("You are an emotion classifier. Reply with one word only.", prompt, temperature=0.3)
         emotion = result.strip().lower()
-        valid = {"happy", "sad", "laughing", "angry", "love", "surprised", "awkward", "cool"}
-        return emotion if emotion in valid else "happy"
+        return emotion if emotion in _EMOTIONS else "happy"
     except Exception:
         return "happy"
 
@@ -1785,7 +2573,7 @@ Reply with only the emotion word, nothing else."""
 
 async def extract_events(messages: list[dict]) -> list[dict]:
     """Extract time-bound events from recent conversation (e.g. '下周面试' → date + description)."""
-    user_texts = [m["content"] for m in messages if m["role"] == "user" and m.get("content")]
+    user_texts = _recent_user_texts(messages, 15)
     if not user_texts:
         return []
 
@@ -1795,7 +2583,7 @@ async def extract_events(messages: list[dict]) -> list[dict]:
     prompt = f"""Today is {today} ({weekday}).
 
 Below are things the user said recently:
-{chr(10).join(f'- {t}' for t in user_texts[-15:])}
+{chr(10).join(f'- {t}' for t in user_texts)}
 
 Extract any events with a specific or implied date/time.
 Examples of things to extract:
@@ -1813,9 +2601,7 @@ JSON only."""
 
     raw = await _chat("You are a date/event extraction tool. Output JSON only.", prompt, temperature=0.3)
     try:
-        if "```" in raw:
-            raw = raw.split("```")[1].replace("json", "").strip()
-        result = json.loads(raw)
+        result = _loads_fenced(raw)
         return result if isinstance(result, list) else []
     except Exception:
         return []
@@ -1825,8 +2611,7 @@ JSON only."""
 
 async def compose_greeting(user_id: str, weather: str = "", calendar: str = "", events: list[dict] = None) -> list[str]:
     """Compose a natural morning greeting incorporating weather, calendar, and due events."""
-    from core.state import UserState
-    st = UserState()
+    st = _state()
 
     profile = st.get_user_profile(user_id) or ""
     memory = st.get_memory_summary(user_id) or ""
@@ -0,0 +1,177 @@
+"""In-process cache for LLM completions — shared by every caller of the agent."""
+from __future__ import annotations
+
+import os
+import json
+import time
+import logging
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+logger = logging.getLogger("core.cache")
+
+try:
+    import orjson
+
+    def _key_blob(parts) -> bytes:
+        return orjson.dumps(parts, default=str, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    def _key_blob(parts) -> bytes:
+        return json.dumps(parts, ensure_ascii=False, default=str).encode()
+
+
+CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))  # seconds; 0 disables
+CACHE_ENABLED = os.getenv("AGENT_RESPONSE_CACHE", "1") != "0"
+CACHE_SIZE = 512
+
+
+class ResponseCache:
+    """LRU of completion text keyed on a hash of the exact request, with a TTL."""
+
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl if CACHE_ENABLED else 0
+        self._data: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.blake2b(_key_blob(parts), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        if self.ttl <= 0:
+            return None
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str):
+        if self.ttl <= 0 or not value:
+            return
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+response_cache = ResponseCache()
+
+
+DISK_CACHE_TTL = float(os.getenv("DISK_CACHE_TTL", str(24 * 3600)))  # seconds; 0 disables
+
+
+def _disk_cache_path() -> str:
+    try:
+        from app.config import DB_PATH
+        return os.path.join(os.path.dirname(DB_PATH), "llm_cache.db")
+    except ImportError:
+        return os.path.join(os.path.dirname(__file__), "..", "llm_cache.db")
+
+
+class DiskCache:
+    """SQLite-backed completion store with the same keys as ResponseCache — survives restarts,
+    so scheduled background jobs over unchanged history don't pay for the same call twice."""
+
+    def __init__(self, path: str = None, ttl: float = DISK_CACHE_TTL):
+        self.path = os.path.abspath(path or _disk_cache_path())
+        self.ttl = ttl if CACHE_ENABLED else 0
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        if not self._ready:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("DELETE FROM completions WHERE expires_at < ?", (time.time(),))
+            conn.commit()
+            self._ready = True
+        return conn
+
+    def get(self, key: str) -> str | None:
+        if self.ttl <= 0:
+            return None
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value FROM completions WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning("[cache] Disk cache read error: %s", e)
+            return None
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float = None):
+        if self.ttl <= 0 or not value:
+            return
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + (ttl or self.ttl)),
+            )
+            conn.commit()
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning("[cache] Disk cache write error: %s", e)
+
+
+disk_cache = DiskCache()
+
+
+SIMILAR_THRESHOLD = 0.9
+SIMILAR_PER_SCOPE = 64
+
+
+def _shingles(text: str) -> frozenset[str]:
+    """Character trigrams of the whitespace-folded text (works for CJK without a tokenizer)."""
+    text = " ".join(text.split()).casefold()
+    return frozenset(text[i:i + 3] for i in range(max(1, len(text) - 2)))
+
+
+class SimilarCache:
+    """Per-scope (input, result) memory that also hits on near-identical inputs — for gating
+    decisions on rolling conversation windows that barely moved since the last call."""
+
+    def __init__(self, threshold: float = SIMILAR_THRESHOLD, per_scope: int = SIMILAR_PER_SCOPE, ttl: float = CACHE_TTL):
+        self.threshold = threshold
+        self.per_scope = per_scope
+        self.ttl = ttl if CACHE_ENABLED else 0
+        self._scopes: dict[tuple, list[tuple[float, frozenset[str], str]]] = {}
+
+    def get(self, scope: tuple, text: str) -> str | None:
+        if self.ttl <= 0:
+            return None
+        entries = self._scopes.get(scope)
+        if not entries:
+            return None
+        now = time.monotonic()
+        entries[:] = [e for e in entries if now - e[0] <= self.ttl]
+        grams = _shingles(text)
+        best, best_sim = None, self.threshold
+        for _, other, value in entries:
+            sim = len(grams & other) / (len(grams | other) or 1)
+            if sim >= best_sim:
+                best, best_sim = value, sim
+        return best
+
+    def set(self, scope: tuple, text: str, value: str):
+        if self.ttl <= 0:
+            return
+        entries = self._scopes.setdefault(scope, [])
+        entries.append((time.monotonic(), _shingles(text), value))
+        del entries[:-self.per_scope]
+
+
+similar_cache = SimilarCache()
@@ -3,8 +3,37 @@ from __future__ import annotations
 
 import sqlite3
 import os
+from collections import OrderedDict
 from datetime import datetime
 
+_HISTORY_CACHE_USERS = 256
+
+# db_path -> (history cache, milestones cache, transcripts), shared by every UserState on
+# that database so co-scheduled analyses read and join the same recent history once
+_SHARED_CACHES: dict[str, tuple[OrderedDict, dict, dict]] = {}
+
+
+def _city_from_profile(profile: str) -> str:
+    """Pull the 所在地 (location) field out of a profile summary."""
+    if not profile:
+        return ""
+    for line in profile.split("\n"):
+        if "所在地" in line:
+            city = line.split(":", 1)[-1].strip().split("：", 1)[-1].strip()
+            return city if city and city != "..." else ""
+    return ""
+
+
+def format_transcript(messages: list[dict], friend: str = "Friend", user: str = "User") -> str:
+    """Messages as "Role: content" lines, skipping empty ones."""
+    lines = []
+    append = lines.append
+    for m in messages:
+        content = m.get("content")
+        if content:
+            append(f"{friend if m['role'] == 'friend' else user}: {content}")
+    return "\n".join(lines)
+
 
 class UserState:
     """Multi-user SQLite state. Each user gets their own namespace."""
@@ -18,6 +47,12 @@ class UserState:
                 db_path = os.path.join(os.path.dirname(__file__), "..", "protagonist.db")
         self.db_path = os.path.abspath(db_path)
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        # history: user_id -> (limit fetched, rows oldest-first); kept warm by add_message(s)
+        # milestones: user_id -> reached counts; append-only, tiny
+        # transcripts: user_id -> {(limit, labels): joined text}; dropped whenever the user gets a message
+        self._history_cache, self._milestones_cache, self._transcripts = _SHARED_CACHES.setdefault(
+            self.db_path, (OrderedDict(), {}, {})
+        )
         self._init_db()
 
     def _init_db(self):
@@ -92,22 +127,70 @@ class UserState:
     # --- Messages ---
 
     def add_message(self, user_id: str, role: str, content: str, msg_type: str = "text"):
+        ts = datetime.now().timestamp()
         conn = self._connect()
         conn.execute(
             "INSERT INTO messages (user_id, role, content, timestamp, type) VALUES (?, ?, ?, ?, ?)",
-            (user_id, role, content, datetime.now().timestamp(), msg_type),
+            (user_id, role, content, ts, msg_type),
+        )
+        conn.commit()
+        conn.close()
+        self._extend_history(user_id, role, [content], msg_type, ts)
+
+    def add_messages(self, user_id: str, role: str, contents: list[str], msg_type: str = "text"):
+        """Insert several messages in one transaction."""
+        if not contents:
+            return
+        ts = datetime.now().timestamp()
+        conn = self._connect()
+        conn.executemany(
+            "INSERT INTO messages (user_id, role, content, timestamp, type) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, role, c, ts, msg_type) for c in contents],
         )
         conn.commit()
         conn.close()
+        self._extend_history(user_id, role, contents, msg_type, ts)
+
+    def _extend_history(self, user_id: str, role: str, contents: list[str], msg_type: str, ts: float):
+        """Append freshly written messages to the cached history instead of dropping it."""
+        self._transcripts.pop(user_id, None)
+        cached = self._history_cache.get(user_id)
+        if cached is None:
+            return
+        limit, rows = cached
+        rows.extend(
+            {"role": role, "content": c, "timestamp": ts, "type": msg_type} for c in contents
+        )
+        del rows[:-limit]
 
     def get_history(self, user_id: str, limit: int = 50) -> list[dict]:
+        cached = self._history_cache.get(user_id)
+        if cached is not None and cached[0] >= limit:
+            self._history_cache.move_to_end(user_id)
+            return [dict(r) for r in cached[1][-limit:]]
         conn = self._connect()
         rows = conn.execute(
             "SELECT role, content, timestamp, type FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
             (user_id, limit),
         ).fetchall()
         conn.close()
-        return [dict(r) for r in reversed(rows)]
+        history = [dict(r) for r in reversed(rows)]
+        self._history_cache[user_id] = (limit, [dict(r) for r in history])
+        self._history_cache.move_to_end(user_id)
+        if len(self._history_cache) > _HISTORY_CACHE_USERS:
+            evicted, _ = self._history_cache.popitem(last=False)
+            self._transcripts.pop(evicted, None)
+        return history
+
+    def get_history_transcript(self, user_id: str, limit: int = 50,
+                               friend: str = "Friend", user: str = "User") -> str:
+        """Recent history as "Role: content" lines, built once until the next message arrives."""
+        per_user = self._transcripts.setdefault(user_id, {})
+        key = (limit, friend, user)
+        text = per_user.get(key)
+        if text is None:
+            text = per_user[key] = format_transcript(self.get_history(user_id, limit), friend, user)
+        return text
 
     def message_count(self, user_id: str) -> int:
         conn = self._connect()
@@ -163,20 +246,41 @@ class UserState:
         conn.commit()
         conn.close()
 
+    def get_watermark(self, user_id: str, key: str) -> int:
+        """Last message id a background analysis ran over (0 if never)."""
+        return int(self.get_meta(user_id, f"watermark:{key}", "0"))
+
+    def set_watermark(self, user_id: str, key: str, msg_id: int):
+        self.set_meta(user_id, f"watermark:{key}", str(msg_id))
+
+    def latest_message_id(self, user_id: str, role: str = None) -> int:
+        conn = self._connect()
+        if role:
+            row = conn.execute(
+                "SELECT MAX(id) as m FROM messages WHERE user_id = ? AND role = ?", (user_id, role),
+            ).fetchone()
+        else:
+            row = conn.execute("SELECT MAX(id) as m FROM messages WHERE user_id = ?", (user_id,)).fetchone()
+        conn.close()
+        return row["m"] or 0
+
     def first_message_time(self, user_id: str) -> float | None:
         val = self.get_meta(user_id, "first_message_time")
         return float(val) if val else None
 
     def milestones_sent(self, user_id: str) -> set[int]:
-        val = self.get_meta(user_id, "milestones_sent", "")
-        if not val:
-            return set()
-        return set(int(x) for x in val.split(",") if x)
+        sent = self._milestones_cache.get(user_id)
+        if sent is None:
+            val = self.get_meta(user_id, "milestones_sent", "")
+            sent = frozenset(int(x) for x in val.split(",") if x)
+            self._milestones_cache[user_id] = sent
+        return set(sent)
 
     def mark_milestone(self, user_id: str, count: int):
         sent = self.milestones_sent(user_id)
         sent.add(count)
         self.set_meta(user_id, "milestones_sent", ",".join(str(x) for x in sent))
+        self._milestones_cache[user_id] = frozenset(sent)
 
     # --- Memory ---
 
@@ -186,6 +290,16 @@ class UserState:
 
     def set_user_profile(self, user_id: str, profile: str):
         self.set_meta(user_id, "user_profile", profile)
+        self.set_meta(user_id, "city", _city_from_profile(profile))
+
+    def get_city(self, user_id: str) -> str:
+        """City parsed from the profile, cached in meta whenever the profile is saved."""
+        city = self.get_meta(user_id, "city")
+        if city is None:
+            # Profile was saved before the city was cached — backfill once
+            city = _city_from_profile(self.get_user_profile(user_id))
+            self.set_meta(user_id, "city", city)
+        return city
 
     def get_memory_summary(self, user_id: str) -> str:
         """Get the rolling conversation memory summary."""
@@ -208,6 +322,42 @@ class UserState:
     def set_mood_log(self, user_id: str, log: str):
         self.set_meta(user_id, "mood_log", log)
 
+    _BUNDLE_META = {
+        "first_message_time": "first_time",
+        "user_profile": "profile",
+        "memory_summary": "summary",
+        "relationship_narrative": "narrative",
+        "mood_log": "mood",
+    }
+
+    def get_memory_bundle(self, user_id: str) -> dict:
+        """Everything the per-turn memory context needs, read over one connection: profile,
+        summary, narrative, mood, first_time, count, refs and promises."""
+        conn = self._connect()
+        bundle = {field: "" for field in self._BUNDLE_META.values()}
+        rows = conn.execute(
+            f"SELECT key, value FROM meta WHERE user_id = ? AND key IN ({','.join('?' * len(self._BUNDLE_META))})",
+            (user_id, *self._BUNDLE_META),
+        ).fetchall()
+        for r in rows:
+            bundle[self._BUNDLE_META[r["key"]]] = r["value"] or ""
+        bundle["first_time"] = float(bundle["first_time"]) if bundle["first_time"] else None
+        bundle["count"] = conn.execute(
+            "SELECT COUNT(*) as c FROM messages WHERE user_id = ? AND role = 'user'",
+            (user_id,),
+        ).fetchone()["c"]
+        bundle["refs"] = [dict(r) for r in conn.execute(
+            "SELECT ref_type, keyword, context, original_quote FROM shared_references "
+            "WHERE user_id = ? ORDER BY created_at DESC LIMIT 15",
+            (user_id,),
+        ).fetchall()]
+        bundle["promises"] = [dict(r) for r in conn.execute(
+            "SELECT thing, original FROM promises WHERE user_id = ? ORDER BY created_at DESC",
+            (user_id,),
+        ).fetchall()]
+        conn.close()
+        return bundle
+
     def get_summarized_up_to(self, user_id: str) -> int:
         """Get the message count up to which we've summarized."""
         val = self.get_meta(user_id, "summarized_up_to", "0")
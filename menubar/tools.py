@@ -5,8 +5,10 @@ import os
 import json
 import asyncio
 import base64
+import signal
 import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 
 # --------------- Tool Registry ---------------
@@ -65,12 +67,30 @@ async def execute_tool(name: str, args: dict) -> str:
 
 # --------------- Helpers ---------------
 
+# Bound concurrent child processes and blocking work so a burst of tool
+# calls from several chats can't starve the event loop.
+_proc_sem = asyncio.Semaphore(8)
+_io_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="tools-io")
+
+
+async def _run_blocking(fn, *args):
+    """Run a blocking call on the shared I/O pool."""
+    return await asyncio.get_running_loop().run_in_executor(_io_pool, fn, *args)
+
+
+def _fetch_json(req, timeout: float) -> dict:
+    import urllib.request
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode())
+
+
 async def _applescript(script: str) -> str:
-    proc = await asyncio.create_subprocess_exec(
-        "osascript", "-e", script,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-    )
-    stdout, stderr = await proc.communicate()
+    async with _proc_sem:
+        proc = await asyncio.create_subprocess_exec(
+            "osascript", "-e", script,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
     if proc.returncode != 0:
         return f"AppleScript error: {stderr.decode().strip()}"
     return stdout.decode().strip()
@@ -78,19 +98,31 @@ async def _applescript(script: str) -> str:
 
 async def _shell(cmd: str, timeout: int = 30) -> str:
     try:
-        proc = await asyncio.create_subprocess_shell(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        )
-        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        async with _proc_sem:
+            # Own process group, so a timeout takes down the whole pipeline, not just sh
+            proc = await asyncio.create_subprocess_shell(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True,
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+            except asyncio.TimeoutError:
+                await _reap(proc)
+                return "(timed out)"
         output = stdout.decode() + stderr.decode()
         return output.strip() if output.strip() else "(no output)"
-    except asyncio.TimeoutError:
-        proc.kill()
-        return "(timed out)"
     except Exception as e:
         return f"Error: {e}"
 
 
+async def _reap(proc: asyncio.subprocess.Process):
+    """Kill proc's process group and wait for it, so no zombie or open pipe is left behind."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
 async def _screenshot_analyze(question: str = "Describe what's on screen", app_name: str = None) -> str:
     """Screenshot + GPT-4V analysis."""
     from openai import AsyncOpenAI
@@ -169,8 +201,7 @@ async def _graph_refresh_token() -> str | None:
             data=data,
             headers={"Content-Type": "application/x-www-form-urlencoded"},
         )
-        resp = urllib.request.urlopen(req, timeout=15)
-        result = json.loads(resp.read().decode())
+        result = await _run_blocking(_fetch_json, req, 15)
         tokens["access_token"] = result["access_token"]
         if "refresh_token" in result:
             tokens["refresh_token"] = result["refresh_token"]
@@ -211,8 +242,7 @@ async def _graph_api(endpoint: str, method: str = "GET", body: dict = None) -> d
         else:
             data = None
         req = urllib.request.Request(url, data=data, headers=headers, method=method)
-        resp = urllib.request.urlopen(req, timeout=20)
-        return json.loads(resp.read().decode())
+        return await _run_blocking(_fetch_json, req, 20)
     except urllib.error.HTTPError as e:
         if e.code == 401:
             # Token expired, try refresh
@@ -221,8 +251,7 @@ async def _graph_api(endpoint: str, method: str = "GET", body: dict = None) -> d
                 headers["Authorization"] = f"Bearer {new_token}"
                 req = urllib.request.Request(url, data=data if body else None, headers=headers, method=method)
                 try:
-                    resp = urllib.request.urlopen(req, timeout=20)
-                    return json.loads(resp.read().decode())
+                    return await _run_blocking(_fetch_json, req, 20)
                 except Exception as e2:
                     return f"Graph API error after refresh: {e2}"
             return "EMAIL_AUTH_NEEDED"
@@ -244,8 +273,7 @@ async def _graph_device_code_auth() -> str:
         data=data,
         headers={"Content-Type": "application/x-www-form-urlencoded"},
     )
-    resp = urllib.request.urlopen(req, timeout=15)
-    result = json.loads(resp.read().decode())
+    result = await _run_blocking(_fetch_json, req, 15)
 
     user_code = result["user_code"]
     device_code = result["device_code"]
@@ -270,8 +298,7 @@ async def _graph_device_code_auth() -> str:
                     data=poll_data,
                     headers={"Content-Type": "application/x-www-form-urlencoded"},
                 )
-                poll_resp = urllib.request.urlopen(poll_req, timeout=15)
-                tokens = json.loads(poll_resp.read().decode())
+                tokens = await _run_blocking(_fetch_json, poll_req, 15)
                 _save_graph_tokens({
                     "access_token": tokens["access_token"],
                     "refresh_token": tokens.get("refresh_token", ""),
@@ -1018,11 +1045,11 @@ async def _create_document(type: str, title: str, content: str) -> str:
 
     try:
         if type == "word":
-            await asyncio.get_event_loop().run_in_executor(None, _markdown_to_docx, title, content, path)
+            await _run_blocking(_markdown_to_docx, title, content, path)
         elif type == "slides":
-            await asyncio.get_event_loop().run_in_executor(None, _markdown_to_pptx, title, content, path)
+            await _run_blocking(_markdown_to_pptx, title, content, path)
         elif type == "pdf":
-            await asyncio.get_event_loop().run_in_executor(None, _markdown_to_pdf, title, content, path)
+            await _run_blocking(_markdown_to_pdf, title, content, path)
         else:
             return f"不支持的文档类型: {type}"
     except Exception as e: